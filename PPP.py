@@ -33,80 +33,42 @@ Uses GNU General Public License
 import warnings
 import json                                  # for saving of variables
 import re                                    # for verifying input variables
-import urllib                                # for Plex POST
-from xml.etree import ElementTree            # for xml
 import argparse                              # for arguments
-import shutil                                # for deleting files
 import os                                    # for folder and file management
 import io                                    # character encoding
-from collections import OrderedDict          # url ordering
-import requests                              # HTTP POST requests
-from datetime import datetime                # for timestamp
-
-vers = "v3.0.6"
+import sys                                   # for quiet mode
+from ppp import MultiSync, PPPError, PlexClient, SyncEngine, convertPath, vers
+from ppp.config import loadVariables
+from ppp.m3u import EXTENSIONS, readPlaylist
+from ppp.targets import targetVariables
+from ppp.util import br, runTime
 
 
 # --- FUNCTIONS ---
 
-def br():
-    print("\n------\n")
-
-
-def plexGetRequest(url, plex_token, check_ssl):
-    print("URL: " + url.replace(plex_token, "***********"))
-    try:
-        resp = requests.get(url, timeout=30, verify=check_ssl)
-        if resp.ok:
-            print("Request was successful.")
-            br()
-            return ElementTree.fromstring(resp.text)
-    except Exception:
-        print("ERROR: Issue encountered with request.")
-        raise SystemExit
-
-    print("ERROR: Request failed.")
-    print('ERROR: Return code: %d Reason: %s' %
-          (resp.status_code, resp.reason))
-    raise SystemExit
-
-
-def plexSections(server_url, plex_token, check_ssl):
-    print("Requesting section info from Plex...")
-    url = server_url + "/library/sections/all?X-Plex-Token=" + plex_token
-    root = plexGetRequest(url, plex_token, check_ssl)
-    br()
-    print("ID: SECTION")
-    for document in root.findall("Directory"):
-        if document.get('type') == "artist":
-            print(document.get('key') + ': ' +
-                  document.get('title').strip())
-
-
-def plexPlaylistKeys(server_url, plex_token, check_ssl):
-    print("Requesting playlists from Plex...")
-    url = server_url + "/playlists/?X-Plex-Token=" + plex_token
-    root = plexGetRequest(url, plex_token, check_ssl)
-    keys = []
-    for document in root.findall("Playlist"):
-        if document.get('smart') == "0" and document.get('playlistType') == "audio":
-            keys.append(document.get('key'))
-    print("Found " + str(len(keys)) + " playlists.")
-    br()
-    return keys
+class QuietOutput:
+    # Stands in for stdout with -quiet, passing on only warnings and errors,
+    # and any indented lines which follow them (e.g. the playlists which
+    # failed to upload)
 
+    def __init__(self, stream):
+        self.stream = stream
+        self.line = ''
+        self.passing = False
 
-def plexPlaylist(server_url, plex_token, key, check_ssl):
-    print("Requesting playlist data from Plex...")
-    url = server_url + key + "?X-Plex-Token=" + plex_token
-    root = plexGetRequest(url, plex_token, check_ssl)
-    title = root.get("title")
-    print("Found playlist: " + title)
-    playlist = []
-    for document in root.findall("Track"):
-        playlist.append(document[0][0].get('file'))
+    def write(self, text):
+        lines = (self.line + text).split('\n')
+        self.line = lines.pop()
+        for line in lines:
+            if line.startswith(('ERROR', 'WARNING')):
+                self.passing = True
+            elif not line.startswith(' ') or not line.strip():
+                self.passing = False
+            if self.passing:
+                self.stream.write(line + '\n')
 
-    print("Found " + str(len(playlist)) + " songs.")
-    return title, playlist
+    def flush(self):
+        self.stream.flush()
 
 
 def setupVariables():
@@ -179,8 +141,10 @@ def setupVariables():
 
     br()
 
+    plex = PlexClient(server_url, plex_token, check_ssl == "True")
+
     # Fetch Plex music playlist keys
-    keys = plexPlaylistKeys(server_url, plex_token, check_ssl)
+    keys = plex.playlistKeys()
 
     br()
 
@@ -190,7 +154,7 @@ def setupVariables():
         raise SystemExit
 
     print("Fetching sample playlist(s) to determine prepend...")
-    _, playlist = plexPlaylist(server_url, plex_token, keys[0], check_ssl)
+    _, playlist = plex.playlist(keys[0])
     plex_unix = playlist[0].startswith("/")
 
     print("It looks like your Plex machine uses %s paths" %
@@ -198,8 +162,7 @@ def setupVariables():
 
     # If we have more than one playlist add the second to get better deta for the prefix
     if len(keys) > 1:
-        _, playlist_extra = plexPlaylist(
-            server_url, plex_token, keys[1], check_ssl)
+        _, playlist_extra = plex.playlist(keys[1])
         playlist = playlist + playlist_extra
 
     # Convert from Windows to UNIX paths
@@ -235,14 +198,14 @@ def setupVariables():
     playlistsFound = False
     for root, _, files in os.walk(local_playlists):
         for file in files:
-            if file.endswith('.m3u'):
+            if file.endswith(EXTENSIONS):
                 playlistsFound = True
-                playlist = io.open(
-                    os.path.join(root, file), 'r', encoding='utf8').read().splitlines()
+                playlist = [track.path for track in
+                            readPlaylist(os.path.join(root, file)).tracks]
                 break
 
     if not playlistsFound:
-        print("ERROR: We couldn't find any .m3u playlists!")
+        print("ERROR: We couldn't find any .m3u or .m3u8 playlists!")
         input("If this is expected (i.e. you want to sync playlists from Plex) press enter to continue...")
 
     local_unix = playlist[0].startswith("/")
@@ -292,7 +255,10 @@ def setupVariables():
           "Due to Plex API limitations, all music to be added to playlists must be in the same library.")
 
     # Display discovered library sections
-    plexSections(server_url, plex_token, check_ssl)
+    br()
+    print("ID: SECTION")
+    for key, title in plex.sections():
+        print(key + ': ' + title)
 
     section_id = input("Please enter your music section ID: ")
 
@@ -336,107 +302,161 @@ def getArguments():
     parser.add_argument('-setup', action='store_true',
                         help='Force-run the setup procedure')
 
+    parser.add_argument('-quiet', action='store_true',
+                        help='Only print warnings and errors, and never ask for input (e.g. for cron)')
+
     parser.add_argument('-nobackups', action='store_true',
                         help='Disable backup of local playlists completely!')
 
     parser.add_argument('-retention', metavar='n', type=int, nargs=1, default=[10],
                         help='Number of previous local playlist backups to keep (Default 10)')
 
-    parser.add_argument('-nocleanup', action='store_true',
-                        help='Disable removal of .tmp directory (for debug)')
+    parser.add_argument('-backupmode', metavar='mode', nargs=1, default=['copy'],
+                        choices=['copy', 'dedup', 'archive'],
+                        help="'copy' for a full copy of local playlists each run, 'dedup' to store each distinct file only once, 'archive' for a compressed archive each run (Default copy)")
 
-    return parser.parse_args()
+    parser.add_argument('-listbackups', action='store_true',
+                        help='List backups of local playlists and exit')
 
+    parser.add_argument('-restore', metavar='backup', nargs=1,
+                        help='Restore local playlists from a backup and exit')
 
-def backupLocal():
-    if not args.nobackups:
-        backups = os.listdir('local_backups')
-        backup_time = [b.replace('-', '') for b in backups]
+    parser.add_argument('-playlist', metavar='name', action='append',
+                        help='Only sync this playlist, by name or Plex key. Can be given more than once')
 
-        while len(backups) > args.retention[0]:
-            print('INFO: Number of backups (%i) exceeds backup retention (%i)' %
-                  (len(backups), args.retention[0]))
-            oldest_backup = backup_time.index(min(backup_time))
+    parser.add_argument('-watch', action='store_true',
+                        help='Keep running, and sync whenever local playlists change')
 
-            # Delete oldest backup
-            shutil.rmtree(os.path.join(
-                'local_backups', backups[oldest_backup]))
-            del backups[oldest_backup], backup_time[oldest_backup]
+    parser.add_argument('-pollinterval', metavar='s', type=int, nargs=1, default=[60],
+                        help='Seconds between checks for changes in Plex when using -watch (Default 60)')
 
-            print('Deleted oldest backup')
-            br()
+    parser.add_argument('-debounce', metavar='s', type=int, nargs=1, default=[2],
+                        help='Seconds to wait for local playlists to stop changing before syncing when using -watch (Default 2)')
 
-        # Backup local playlists
-        try:
-            print('Backing up local playlists...\n')
-            shutil.copytree(v['local_playlists'],
-                            os.path.join('local_backups', runtime))
-            print('Backed up local playlists to ' +
-                  os.path.join('local_backups', runtime))
-        except Exception:
-            print('Directory not copied.')
-            print('ERROR: %s' % Exception)
-            raise SystemExit
+    parser.add_argument('-dryrun', action='store_true',
+                        help='Show what a sync would change, without backing up, sending to Plex or changing local playlists')
 
-        # Calculate backup size
-        size = sum(os.path.getsize(os.path.join(dirpath, filename)) for dirpath, dirnames,
-                   filenames in os.walk('local_backups') for filename in filenames) / 1024 / 1024
-        print('INFO: Your backups are currently taking up %sMB of space' %
-              round(size, 2))
+    parser.add_argument('-diff', metavar='path', nargs=1, default=[None],
+                        help='Save the changes a dry run would make to this JSON file (implies -dryrun)')
 
-    else:
-        print('Not backing up local playlists. If this was NOT intentional, exit the program immediately\n')
+    parser.add_argument('-metrics', metavar='path', nargs=1, default=['metrics.json'],
+                        help='Save the timings and counts of each sync to this JSON file (Default metrics.json)')
 
-    br()
+    parser.add_argument('-prometheus', metavar='path', nargs=1, default=[None],
+                        help='Also save them to this file in the Prometheus text format, for the node exporter textfile collector')
 
+    parser.add_argument('-nocleanup', action='store_true',
+                        help='Disable removal of .tmp directory, and save each stage of the sync to .tmp/debug (for debug)')
 
-def setupFolders():
+    parser.add_argument('-full', action='store_true',
+                        help='Sync every playlist, even if unchanged since the last run')
 
-    # Remove existing temporary directory
-    if os.path.isdir(_tmp):
-        try:
-            shutil.rmtree(_tmp)
-        except Exception as e:
-            print("ERROR: I couldn't remove existing .tmp folder. Try deleting manually?")
-            print(e)
-            raise SystemExit
+    parser.add_argument('-noindex', action='store_true',
+                        help="Don't index the music library to match tracks which have been moved or renamed")
 
-    # Folder operations
-    try:
-        print('Attempting to make .tmp folders')
-        os.makedirs(_tmp)
-        os.makedirs(_plex)
-        os.makedirs(_local)
-        os.makedirs(_merged)
-        print('Successfully created .tmp folders')
-
-    except Exception as e:
-        print("OH NO: Couldn't make tmp directories... check your permissions or make sure you don't have them open elsewhere")
-        print('ERROR: %s' % e)
-        raise SystemExit
+    parser.add_argument('-workers', metavar='n', type=int, nargs=1, default=[4],
+                        help='Number of playlists to download from Plex at once (Default 4)')
 
-    # Create backups folder if required
-    if not os.path.isdir('local_backups') and not args.nobackups:
-        print('No local backups detected... making local_backups folder.')
-        os.makedirs('local_backups')
+    parser.add_argument('-connections', metavar='n', type=int, nargs=1, default=[4],
+                        help='Maximum simultaneous connections to the Plex server (Default 4)')
 
-    br()
+    parser.add_argument('-pagesize', metavar='n', type=int, nargs=1, default=[5000],
+                        help='Download Plex playlists longer than this in pages of n tracks, 0 to disable (Default 5000)')
+
+    parser.add_argument('-cachesize', metavar='n', type=int, nargs=1, default=[500000],
+                        help='Number of tracks to keep in the cache of downloaded Plex playlists, 0 to disable (Default 500000)')
+
+    parser.add_argument('-localworkers', metavar='n', type=int, nargs=1, default=[8],
+                        help='Number of local folders or playlists to read at once (Default 8)')
+
+    parser.add_argument('-uploadworkers', metavar='n', type=int, nargs=1, default=[2],
+                        help='Number of playlists to send to Plex at once (Default 2)')
+
+    parser.add_argument('-pushmode', metavar='mode', nargs=1, default=['upload'],
+                        choices=['upload', 'items'],
+                        help="'upload' to have Plex import each updated playlist from working_directory_plex, 'items' to only add the tracks which are new (Default upload)")
+
+    parser.add_argument('-batchsize', metavar='n', type=int, nargs=1, default=[200],
+                        help='Number of tracks to add to a Plex playlist in each request when using -pushmode items (Default 200)')
+
+    parser.add_argument('-pipeline', action='store_true',
+                        help='Merge and send each playlist as soon as it has downloaded, instead of one stage at a time')
+
+    parser.add_argument('-timeout', metavar='s', type=int, nargs=1, default=[300],
+                        help='Seconds to wait for Plex to import each playlist (Default 300)')
+
+    parser.add_argument('-retries', metavar='n', type=int, nargs=1, default=[3],
+                        help='Number of times to retry a failed playlist upload (Default 3)')
+
+    return parser.parse_args()
 
 
-def convertPath(path, convert, invert):
-    if convert == False:
-        return path
-    elif (convert == 'w2u' and not invert) or (convert == 'u2w' and invert):
-        return path.replace("/", "\\")
+def describeTarget(v):
+    print("I'll ignore " + str(v['local_prepend']) + " from local playlists and " +
+          str(v['plex_prepend']) + " from Plex playlists\n")
+
+    # Check if Plex playlists need to be converted
+    if v['plex_convert'] == "w2u":
+        print("Plex playlists will be converted from Windows to Unix directories")
+    elif v['plex_convert'] == "u2w":
+        print("Plex playlists will be converted from Unix to Windows directories")
     else:
-        return path.replace("\\", "/")
+        print("Plex playlist paths will not be converted")
 
+    # Check if local playlists need to be converted
+    if v['local_convert'] == "w2u":
+        print("Local playlists will be converted from Windows to Unix directories")
+    elif v['local_convert'] == "u2w":
+        print("Local playlists will be converted from Unix to Windows directories")
+    else:
+        print("Local playlist paths will not be converted")
 
-def stripPrepend(path, prepend, invert):
-    if not invert:
-        return path.replace(prepend, '')
+    if v['check_ssl'] == "False":
+        print("SSL certificates will not be validated")
+        warnings.filterwarnings('ignore', message='Unverified HTTPS request')
     else:
-        return prepend + path
+        print("SSL certificates will be validated")
+    br()
+
+
+def report(result):
+    # A sync to several targets is reported target by target, then as a whole
+    if hasattr(result, 'targets'):
+        for name, target in result.targets.items():
+            print('\nTarget %s:' % name)
+            if name in result.errors:
+                print('ERROR: %s' % result.errors[name])
+            report(target)
+        print('\nSynced %d of %d targets in %.1fs' %
+              (len(result.targets) - len(result.errors), len(result.targets),
+               result.metrics.seconds))
+        return
+
+    # The pipeline syncs each playlist as it downloads, so only the playlists
+    # which failed are missed
+    if result.download_errors and args.pipeline:
+        print('\nERROR: %d playlists failed to download from Plex and were skipped' %
+              len(result.download_errors))
+    elif result.download_errors:
+        print('\nERROR: %d playlists failed to download from Plex, nothing has been synced' %
+              len(result.download_errors))
+
+    if result.uploaded:
+        print('Sent %d of %d playlists to Plex' %
+              (len(result.uploaded) - len(result.failed), len(result.uploaded)))
+
+    if result.copied or result.up_to_date:
+        print('Copied %d changed playlists to local playlists, %d already up to date' %
+              (len(result.copied), len(result.up_to_date)))
+
+    if result.failed:
+        print('\nERROR: %d playlists failed to update to plex:' % len(result.failed))
+        for name, ok, attempts, _, error in result.uploaded:
+            if not ok:
+                print('  %s: %s' % (name, error))
+
+    print('Finished in %.1fs (%s)' % (result.metrics.seconds, ', '.join(
+        '%s %.1fs' % (name, seconds) for name, seconds in result.metrics.stages.items())))
 
 
 # --- MAIN ---
@@ -444,6 +464,9 @@ def stripPrepend(path, prepend, invert):
 # Get passed arguments
 args = getArguments()
 
+if args.quiet:
+    sys.stdout = QuietOutput(sys.stdout)
+
 print("""
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # 
 #                     _____  _____  _____                         #
@@ -462,254 +485,104 @@ print("""
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # 
 \n""")
 
-runtime = str(datetime.now().replace(microsecond=0)
-              ).replace(' ', '-').replace(':', '-')
-print('Running PPP at ' + runtime + '\n')
+print('Running PPP at ' + runTime() + '\n')
+
+if args.quiet and (args.setup or not os.path.exists('variables.json')):
+    # Setup asks questions, which nobody is there to answer
+    print("ERROR: Couldn't find variables.json, run PPP.py -setup without -quiet first")
+    raise SystemExit
 
 if not args.setup:
     print("Attempting to load existing variables...\n")
 
     if os.path.exists('variables.json'):
-        if not os.access('variables.json', os.R_OK):
-            print("ERROR: Unable to load variables... variables.json file not readable.")
-            raise SystemExit
         try:
-            f = open('variables.json')
-            v = json.load(f)
+            v = loadVariables('variables.json')
             print("Variables loaded successfully!")
-        except Exception as e:
-            print("ERROR: Unable to load variables... check file contains valid json!")
+        except PPPError as e:
+            print("ERROR: Unable to load variables... %s" % e)
             raise SystemExit
-    else:
+
+# Setup talks to Plex to check the server and work out the prepends
+try:
+    if args.setup:
+        print("Forcing setup sequence...")
+        v = setupVariables()
+    elif not os.path.exists('variables.json'):
         print("INFO: Couldn't find existing variables... proceeding with initial setup\n")
         v = setupVariables()
-else:
-    print("Forcing setup sequence...")
-    v = setupVariables()
-
-br()
-
-print("I'll ignore " + v['local_prepend'] + " from local playlists and " +
-      v['plex_prepend'] + " from Plex playlists\n")
-
-# Check if Plex playlists need to be converted
-if v['plex_convert'] == "w2u":
-    print("Plex playlists will be converted from Windows to Unix directories")
-elif v['plex_convert'] == "u2w":
-    print("Plex playlists will be converted from Unix to Windows directories")
-else:
-    print("Plex playlist paths will not be converted")
-
-# Check if local playlists need to be converted
-if v['local_convert'] == "w2u":
-    print("Local playlists will be converted from Windows to Unix directories")
-elif v['local_convert'] == "u2w":
-    print("Local playlists will be converted from Unix to Windows directories")
-else:
-    print("Local playlist paths will not be converted")
-
-if v['check_ssl'] == "False":
-    print("SSL certificates will not be validated")
-    warnings.filterwarnings('ignore', message='Unverified HTTPS request')
-    check_ssl = False
-else:
-    print("SSL certificates will be validated")
-    check_ssl = True
-br()
-
-# Create tmp and backup folders if required
-_tmp = os.path.join(v["working_directory"], '.tmp')
-_local = os.path.join(_tmp, 'local')
-_plex = os.path.join(_tmp, 'plex')
-_merged = os.path.join(_tmp, 'merged')
-
-setupFolders()
-
-# Run backups of local playlists
-backupLocal()
-
-# Get keys for all Plex music playlists
-keys = plexPlaylistKeys(v['server_url'], v['plex_token'], check_ssl)
-
-# Copies Plex playlists to .tmp/plex/ folder
-for key in keys:
-    title, playlist = plexPlaylist(
-        v['server_url'], v['plex_token'], key, check_ssl)
-
-    # Strip prepend
-    playlist = [stripPrepend(track, v['plex_prepend'], False)
-                for track in playlist]
-
-    # Convert to PPP path style
-    playlist = [convertPath(track, v['plex_convert'], False)
-                for track in playlist]
-
-    print('Saving Plex playlist: ' + title)
-
-    # Get each track and save to file
-    f = io.open(os.path.join(_plex, title + '.m3u'),
-                'w+', encoding='utf8')
-    for track in playlist:
-        f.write(track + '\n')
-    f.close()
-
-    print('Save successful!')
-
-    br()
-
-# Copies local playlists to .tmp/local/ folder
-for root, dirs, files in os.walk(v['local_playlists']):
-    for file in files:
-        file_path = os.path.join(root, file)
-
-        if file.endswith('.m3u'):
-
-            playlist = io.open(
-                file_path, 'r', encoding='utf8').read().splitlines()
-
-            # Strip prepend
-            playlist = [stripPrepend(track, v['local_prepend'], False)
-                        for track in playlist]
-
-            # Convert to PPP path style
-            playlist = [convertPath(track, v['local_convert'], False)
-                        for track in playlist]
-
-            print(('Copying local playlist: ' + file_path))
-
-            # Get each track and save to file
-            f = io.open(os.path.join(_local, file),
-                        'w+', encoding='utf8')
-            for track in playlist:
-                f.write(track + '\n')
-            f.close()
+except PPPError as e:
+    print('ERROR: %s' % e)
+    raise SystemExit
 
 br()
 
-# Checks for unique playlists to .tmp/plex/, and moves them to .tmp/merged/
-for filename in os.listdir(_plex):
-    if not os.path.isfile(os.path.join(_local, filename)):
-        print(('Found new Plex playlist: ' + filename))
-
-        os.rename(os.path.join(_plex, filename),
-                  os.path.join(_merged, filename))
-
-        br()
-
-# Checks for unique playlists to .tmp/local/, and copies them to .tmp/merged/
-for filename in os.listdir(_local):
-    if not os.path.isfile(os.path.join(_plex, filename)):
-        print(('Found new local playlist: ' + filename))
-
-        os.rename(os.path.join(_local, filename),
-                  os.path.join(_merged, filename))
-
-        br()
-
-# Merges playlists from tmp/local/ and tmp/plex/ and puts the output in tmp/merged
-for filename in os.listdir(_local):
-
-    print(('Merging: ' + filename))
-
-    local_tracks = io.open(os.path.join(
-        _local, filename), 'r', encoding='utf8').read().splitlines()
-
-    plex_tracks = io.open(os.path.join(
-        _plex, filename), 'r', encoding='utf8').read().splitlines()
-
-    f = io.open(os.path.join(_merged, filename), 'w+', encoding='utf8')
-
-    for line in local_tracks:  # Writes local_tracks to merged playlist
-        if not line.startswith('#'):  # Skips m3u tags beginning with #
-            f.write(line + '\n')
-        if line in plex_tracks:  # Remove duplicates
-            plex_tracks.remove(line)
-
-    for line in plex_tracks:  # Writes plex_tracks to merged playlist
-        f.write(line + '\n')
-    f.close()
+try:
+    # variables.json may list several targets (Plex servers or libraries)
+    # to sync the same local playlists to
+    targets = targetVariables(v)
+    for name, target in targets:
+        if name:
+            print('Target %s: %s, section %s' % (name, target['server_url'], target['section_id']))
+        describeTarget(target)
+
+    engine = (MultiSync if 'targets' in v else SyncEngine)(
+        v,
+        workers=args.workers[0],
+        connections=args.connections[0],
+        page_size=args.pagesize[0],
+        cache_size=args.cachesize[0],
+        local_workers=args.localworkers[0],
+        upload_workers=args.uploadworkers[0],
+        timeout=args.timeout[0],
+        retries=args.retries[0],
+        backups=not args.nobackups,
+        backup_mode=args.backupmode[0],
+        retention=args.retention[0],
+        full=args.full,
+        nocleanup=args.nocleanup,
+        index=not args.noindex,
+        push_mode=args.pushmode[0],
+        batch_size=args.batchsize[0],
+        pipeline=args.pipeline,
+        metrics_path=args.metrics[0],
+        prometheus_path=args.prometheus[0],
+        dry_run=args.dryrun or args.diff[0] is not None)
+
+    if args.listbackups:
+        for backup in engine.listBackups():
+            print(backup)
+        raise SystemExit
 
-br()
+    if args.restore:
+        engine.restore(args.restore[0])
+        raise SystemExit
 
-# Copy merged playlists back into tmp/plex/ and tmp/local/ with prepends re-added
-for filename in os.listdir(_merged):
-    new_tracks = io.open(os.path.join(_merged, filename),
-                         'r+', encoding='utf8').read().splitlines()
-    plex_tracks = []
-    local_tracks = []
-
-    for track in new_tracks:  # Re-adds prepends and writes to files
-        plex_tracks.append(stripPrepend(convertPath(
-            track, v['plex_convert'], True), v['plex_prepend'], True))
-
-        local_tracks.append(stripPrepend(convertPath(
-            track, v['local_convert'], True), v['local_prepend'], True))
-
-    # Writes local tracks back to local tmp
-    f = io.open(os.path.join(_local, filename), 'w+', encoding='utf8')
-    for line in local_tracks:
-        f.write(line + '\n')
-    f.close()
-
-    # Writes plex tracks back to plex tmp
-    f = io.open(os.path.join(_plex, filename), 'w+', encoding='utf8')
-    for line in plex_tracks:
-        f.write(line + '\n')
-    f.close()
-
-# POST new playlists to Plex
-url = v['server_url'] + '/playlists/upload?'
-headers = {'cache-control': "no-cache"}
-
-failed = 0
-for filename in os.listdir(_plex):
-    print('Sending updated playlist to Plex: ' + filename)
-
-    _plex_path = convertPath(os.path.join(
-        v['working_directory_plex'], '.tmp', 'plex', filename), v['plex_convert'], True)
-
-    querystring = urllib.parse.urlencode(OrderedDict(
-        [("sectionID", v['section_id']), ("path", _plex_path), ("X-Plex-Token", v['plex_token'])]))
-    resp = requests.post(
-        url, data="", headers=headers, params=querystring, verify=check_ssl)
-
-    # If the post failed then print the return code and the reason for failing.
-    if not resp.ok:
-        print('ERROR: Return code: %d Reason: %s' %
-              (resp.status_code, resp.reason))
-        failed += 1
+    if args.watch:
+        from ppp.watch import watch
+        watch(engine, args.pollinterval[0], args.debounce[0], report, args.playlist)
 
-br()
+    result = engine.run(args.playlist)
+except PPPError as e:
+    print('ERROR: %s' % e)
+    raise SystemExit
+except KeyboardInterrupt:
+    if not args.watch:
+        raise
+    print('Stopped watching for changes')
+    raise SystemExit
 
-# Copy updated local playlists back to v['local_playlists']
-for root, _, files in os.walk(v['local_playlists']):
-    for playlist in files:
-        if playlist.endswith('.m3u'):
-            print('Copying updated playlist to local playlists: ' + playlist)
-            target_path = os.path.join(root, playlist)
-            local_path = os.path.join(_local, playlist)
-
-            if os.path.isfile(local_path):
-                shutil.copy2(local_path, target_path)
-                os.remove(local_path)
-            else:
-                print(
-                    "FAIL: A playlist from v['local_playlists'] was there earlier and now it isn't. I am very confused.")
-                raise SystemExit
-
-# Copy remaining, new playlists to the root directory
-for playlist in os.listdir(_local):
-    shutil.copy2(os.path.join(_local, playlist), v['local_playlists'])
+report(result)
 
-br()
+if result.download_errors or getattr(result, 'errors', None):
+    raise SystemExit
 
-if failed:
-    print('\nERROR: %d playlists failed to update to plex' % failed)
+if engine.dry_run:
+    if args.diff[0]:
+        with io.open(args.diff[0], 'w', encoding='utf8') as f:
+            json.dump(result.diff, f, indent=2)
+        print('Saved changes to ' + args.diff[0])
+    print('Dry run complete, nothing was changed\n')
+    raise SystemExit
 
-if not args.nocleanup:
-    try:
-        shutil.rmtree(_tmp)
-        print('Complete!\n')
-    except shutil.Error as e:
-        print("Program complete, but I had trouble cleaning .tmp directory. Check it's not open somewhere else \n ERROR: %s" % e)
-        raise SystemExit
+print('Complete!\n')
@@ -0,0 +1,182 @@
+"""
+Benchmark of a full PPP sync against a stand-in Plex server.
+
+Generates a synthetic music library and set of playlists, serves them from
+fakeplex.py with the given latency, and times three syncs through the ppp
+package: the first sync, a sync with nothing changed, and a sync after some
+local playlists were edited. Prints the time taken by each stage of each
+sync, and the peak memory used.
+
+    python3 benchmarks/benchmark.py -playlists 1000 -tracks 5000
+"""
+
+import argparse                              # for arguments
+import contextlib                            # for hiding PPP's output
+import io                                    # character encoding
+import json                                  # for the seed file
+import os                                    # for folder and file management
+import random                                # for synthetic playlists
+import resource                              # for peak memory
+import shutil                                # for deleting files
+import subprocess                            # for the server
+import sys                                   # for the ppp package
+import tempfile                              # for the benchmark directory
+import time                                  # for timing
+import tracemalloc                           # for peak memory
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ppp import SyncEngine                   # noqa: E402
+from ppp.m3u import writePlaylist            # noqa: E402
+
+PLEX_PREPEND = '/data/music/'
+LOCAL_PREPENDS = {'unix': ('/home/user/Music/', False),
+                  'windows': ('C:\\Users\\user\\Music\\', 'u2w')}
+
+
+def libraryFiles(count):
+    # Paths relative to the music folder, grouped into albums of 12
+    return ['Artist %d/Album %d/%02d Track %d.mp3' % (i // 120, i // 12, i % 12 + 1, i)
+            for i in range(count)]
+
+
+def generate(folder, args):
+    rng = random.Random(args.seed)
+    library = libraryFiles(args.library)
+    local_prepend, local_convert = LOCAL_PREPENDS[args.paths]
+
+    def localPath(track):
+        path = local_prepend + track
+        return path.replace('/', '\\') if args.paths == 'windows' else path
+
+    local = os.path.join(folder, 'local')
+    os.makedirs(local)
+    playlists = {}
+    for i in range(args.playlists):
+        title = 'Playlist %d' % i
+        tracks = rng.sample(library, min(args.tracks, len(library)))
+        playlists[title] = [PLEX_PREPEND + track for track in tracks]
+
+        # Local copies differ from Plex by a few tracks either way, so every
+        # playlist has something to merge
+        changed = int(len(tracks) * args.changes)
+        local_tracks = tracks[changed:] + rng.sample(library, changed)
+        subfolder = os.path.join(local, 'Folder %d' % (i % 10))
+        os.makedirs(subfolder, exist_ok=True)
+        writePlaylist(os.path.join(subfolder, title + '.m3u'),
+                      [localPath(track) for track in local_tracks])
+
+    seed = os.path.join(folder, 'seed.json')
+    with io.open(seed, 'w', encoding='utf8') as f:
+        json.dump({'library': [PLEX_PREPEND + track for track in library],
+                   'playlists': playlists}, f)
+
+    working_directory = os.path.join(folder, 'working')
+    os.makedirs(working_directory)
+    v = {'server_url': None, 'check_ssl': 'False', 'plex_token': 'benchmark',
+         'local_playlists': local, 'working_directory': working_directory,
+         'working_directory_plex': working_directory, 'section_id': '1',
+         'local_prepend': local_prepend, 'plex_prepend': PLEX_PREPEND,
+         'local_convert': local_convert, 'plex_convert': False}
+    return seed, v
+
+
+def touchPlaylists(local, count, rng):
+    # Add a track to the end of count local playlists
+    paths = sorted(os.path.join(root, file) for root, _, files in os.walk(local)
+                   for file in files)
+    for path in rng.sample(paths, min(count, len(paths))):
+        with io.open(path, 'r', encoding='utf8') as f:
+            lines = f.read().splitlines()
+        lines.append(rng.choice(lines))
+        writePlaylist(path, lines)
+
+
+def startServer(seed, latency):
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'fakeplex.py'),
+                               seed, '-latency', str(latency)], stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+    return server, 'http://127.0.0.1:%d' % port
+
+
+def timedRun(engine, verbose):
+    start = time.time()
+    if verbose:
+        result = engine.run()
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = engine.run()
+    return result, time.time() - start
+
+
+def report(name, result, seconds):
+    counts = result.metrics.counts
+    print('%s: %.2fs, %d requests, %.1fMB received, %d playlists sent%s' %
+          (name, seconds, counts.get('requests', 0), counts.get('bytes_received', 0) / 1024 / 1024,
+           len(result.uploaded), ', %d failed' % len(result.failed) if result.failed else ''))
+    for stage, stage_seconds in result.metrics.stages.items():
+        print('  %-14s %8.3fs' % (stage, stage_seconds))
+    fetches = sorted(result.metrics.fetches.values())
+    if fetches:
+        print('  playlist fetch median %.3fs, slowest %.3fs' %
+              (fetches[len(fetches) // 2], fetches[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PPP against a stand-in Plex server')
+    parser.add_argument('-playlists', type=int, default=100, help='Number of playlists (Default 100)')
+    parser.add_argument('-tracks', type=int, default=1000, help='Tracks per playlist (Default 1000)')
+    parser.add_argument('-library', type=int, default=20000, help='Tracks in the library (Default 20000)')
+    parser.add_argument('-changes', type=float, default=0.02,
+                        help='Fraction of each local playlist which differs from Plex (Default 0.02)')
+    parser.add_argument('-touch', type=int, default=10,
+                        help='Number of local playlists to edit before the last sync (Default 10)')
+    parser.add_argument('-paths', choices=sorted(LOCAL_PREPENDS), default='windows',
+                        help="Path style of local playlists, Plex always uses UNIX paths (Default windows)")
+    parser.add_argument('-latency', type=float, default=0.005,
+                        help='Seconds the server waits before answering each request (Default 0.005)')
+    parser.add_argument('-pushmode', choices=['upload', 'items'], default='upload',
+                        help='Push mode to benchmark (Default upload)')
+    parser.add_argument('-pipeline', action='store_true', help='Benchmark the pipelined sync')
+    parser.add_argument('-workers', type=int, default=4, help='Download workers (Default 4)')
+    parser.add_argument('-seed', type=int, default=0, help='Random seed (Default 0)')
+    parser.add_argument('-tracemalloc', action='store_true',
+                        help='Measure peak Python memory with tracemalloc (slower)')
+    parser.add_argument('-verbose', action='store_true', help="Show PPP's output")
+    parser.add_argument('-keep', action='store_true', help="Don't delete the benchmark directory")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='ppp-benchmark-')
+    print('Generating %d playlists of %d tracks in %s...' % (args.playlists, args.tracks, folder))
+    seed, v = generate(folder, args)
+
+    server, v['server_url'] = startServer(seed, args.latency)
+    try:
+        if args.tracemalloc:
+            tracemalloc.start()
+        engine = SyncEngine(v, workers=args.workers, backups=False, push_mode=args.pushmode,
+                            pipeline=args.pipeline,
+                            state_path=os.path.join(folder, 'state.json'),
+                            index_path=os.path.join(folder, 'track_index.json'),
+                            cache_path=os.path.join(folder, 'playlist_cache.json'),
+                            metrics_path=None)
+
+        report('First sync', *timedRun(engine, args.verbose))
+        report('Nothing changed', *timedRun(engine, args.verbose))
+        touchPlaylists(v['local_playlists'], args.touch, random.Random(args.seed))
+        report('%d playlists edited' % args.touch, *timedRun(engine, args.verbose))
+
+        # ru_maxrss is in kilobytes on Linux
+        print('Peak memory: %.1fMB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        if args.tracemalloc:
+            print('Peak Python memory: %.1fMB' % (tracemalloc.get_traced_memory()[1] / 1024 / 1024))
+    finally:
+        server.terminate()
+        server.wait()
+        if not args.keep:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+Stand-in for the parts of the Plex API used by PPP, for benchmarking.
+
+Serves playlists and a music library from a JSON seed file, and applies
+uploads and playlist item changes to them in memory. Every request waits
+for a configurable latency first, to stand in for a real server's response
+time.
+
+    python3 fakeplex.py seed.json [-port n] [-latency s]
+"""
+
+import argparse                              # for arguments
+import io                                    # character encoding
+import json                                  # for the seed file
+import os                                    # for playlist names
+import threading                             # for the server
+import time                                  # for latency
+import urllib.parse                          # for requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import quoteattr       # for xml
+
+MACHINE_IDENTIFIER = 'fakeplex'
+SECTION_ID = '1'
+
+
+class Library:
+    # Playlists as {ratingKey: {title, updatedAt, items: [(itemID, trackKey)]}}
+    # and tracks as {ratingKey: {file, size, updatedAt}}
+
+    def __init__(self, seed):
+        self.lock = threading.Lock()
+        self.tracks = {}
+        self.keys = {}
+        self.playlists = {}
+        self.next_id = 0
+        for file in seed['library']:
+            self.addTrack(file)
+        for title, files in seed['playlists'].items():
+            self.addPlaylist(title, files)
+
+    def newId(self):
+        self.next_id += 1
+        return self.next_id
+
+    def addTrack(self, file):
+        key = str(len(self.tracks) + 1)
+        self.tracks[key] = {'file': file, 'size': 1000000 + len(self.tracks),
+                            'updatedAt': len(self.tracks) + 1}
+        self.keys[file] = key
+        return key
+
+    def trackKey(self, file):
+        return self.keys.get(file) or self.addTrack(file)
+
+    def addPlaylist(self, title, files):
+        key = str(len(self.playlists) + 1)
+        self.playlists[key] = {'title': title, 'updatedAt': int(time.time()),
+                               'items': [(self.newId(), self.trackKey(f)) for f in files]}
+        return key
+
+    def touch(self, playlist):
+        playlist['updatedAt'] = max(playlist['updatedAt'] + 1, int(time.time()))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which on a kept alive
+    # connection would wait on delayed ACKs and swamp the simulated latency
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, code=200, headers=()):
+        body = body.encode('utf8')
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse(self):
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        return url.path.rstrip('/').split('/'), dict(urllib.parse.parse_qsl(url.query))
+
+    def uriTracks(self, uri):
+        return uri.rsplit('/', 1)[1].split(',')
+
+    def do_GET(self):
+        path, query = self.parse()
+        library = self.server.library
+
+        if path == ['']:
+            return self.send('<MediaContainer machineIdentifier="%s"/>' % MACHINE_IDENTIFIER)
+
+        if path == ['', 'library', 'sections', 'all']:
+            return self.send('<MediaContainer><Directory key="%s" type="artist" title="Music"/>'
+                             '</MediaContainer>' % SECTION_ID)
+
+        if path == ['', 'library', 'sections', SECTION_ID, 'all']:
+            since = int(query.get('updatedAt>>', -1))
+            lines = ['<MediaContainer>']
+            for key, track in list(library.tracks.items()):
+                if track['updatedAt'] > since:
+                    lines.append('<Track ratingKey="%s" updatedAt="%d"><Media><Part file=%s size="%d"/>'
+                                 '</Media></Track>' % (key, track['updatedAt'],
+                                                       quoteattr(track['file']), track['size']))
+            lines.append('</MediaContainer>')
+            return self.send('\n'.join(lines))
+
+        if path == ['', 'playlists']:
+            lines = ['<MediaContainer>']
+            for key, playlist in list(library.playlists.items()):
+                lines.append('<Playlist ratingKey="%s" key="/playlists/%s/items" title=%s smart="0" '
+                             'playlistType="audio" leafCount="%d" updatedAt="%d"/>' %
+                             (key, key, quoteattr(playlist['title']), len(playlist['items']),
+                              playlist['updatedAt']))
+            lines.append('</MediaContainer>')
+            return self.send('\n'.join(lines))
+
+        if len(path) == 4 and path[1] == 'playlists' and path[3] == 'items' and \
+                path[2] in library.playlists:
+            playlist = library.playlists[path[2]]
+            etag = '"%s-%d"' % (path[2], playlist['updatedAt'])
+            if self.headers.get('If-None-Match') == etag:
+                return self.send('', 304)
+            items = playlist['items']
+            start = int(query.get('X-Plex-Container-Start', 0))
+            size = int(query.get('X-Plex-Container-Size', len(items)))
+            lines = ['<MediaContainer size="%d" leafCount="%d" title=%s>' %
+                     (len(items[start:start + size]), len(items), quoteattr(playlist['title']))]
+            for item, key in items[start:start + size]:
+                lines.append('<Track ratingKey="%s" playlistItemID="%d"><Media><Part file=%s/>'
+                             '</Media></Track>' % (key, item, quoteattr(library.tracks[key]['file'])))
+            lines.append('</MediaContainer>')
+            return self.send('\n'.join(lines), headers=[('ETag', etag)])
+
+        self.send('Not found', 404)
+
+    def do_POST(self):
+        path, query = self.parse()
+        library = self.server.library
+
+        if path == ['', 'playlists', 'upload']:
+            # Plex reads the playlist from its own filesystem
+            title = os.path.splitext(os.path.basename(query['path']))[0]
+            with io.open(query['path'], 'r', encoding='utf-8-sig') as f:
+                files = [line for line in f.read().splitlines()
+                         if line.strip() and not line.startswith('#')]
+            with library.lock:
+                for playlist in library.playlists.values():
+                    if playlist['title'] == title:
+                        keys = [library.trackKey(file) for file in files]
+                        if keys != [key for _, key in playlist['items']]:
+                            playlist['items'] = [(library.newId(), key) for key in keys]
+                            library.touch(playlist)
+                        break
+                else:
+                    library.addPlaylist(title, files)
+            return self.send('')
+
+        if path == ['', 'playlists']:
+            with library.lock:
+                key = library.addPlaylist(query['title'], [])
+                playlist = library.playlists[key]
+                playlist['items'] = [(library.newId(), track) for track in self.uriTracks(query['uri'])]
+            return self.send('<MediaContainer><Playlist ratingKey="%s"/></MediaContainer>' % key)
+
+        self.send('Not found', 404)
+
+    def do_PUT(self):
+        path, query = self.parse()
+        library = self.server.library
+        if len(path) == 4 and path[1] == 'playlists' and path[3] == 'items':
+            with library.lock:
+                playlist = library.playlists[path[2]]
+                playlist['items'] += [(library.newId(), track) for track in self.uriTracks(query['uri'])]
+                library.touch(playlist)
+            return self.send('')
+        self.send('Not found', 404)
+
+
+def serve(seed, port=0, latency=0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.library = Library(seed)
+    server.latency = latency
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in Plex server for benchmarking PPP')
+    parser.add_argument('seed', help='JSON file of {"library": [files], "playlists": {title: [files]}}')
+    parser.add_argument('-port', type=int, default=0, help='Port to listen on (Default any free port)')
+    parser.add_argument('-latency', type=float, default=0,
+                        help='Seconds to wait before answering each request (Default 0)')
+    args = parser.parse_args()
+
+    with io.open(args.seed, 'r', encoding='utf8') as f:
+        server = serve(json.load(f), args.port, args.latency)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
@@ -0,0 +1,21 @@
+"""
+--- PPP (Plex Playlist Pusher) ---
+Library behind PPP.py, for running syncs from other Python programs.
+
+    from ppp import SyncEngine
+    result = SyncEngine(v).run()
+
+where v holds the variables from variables.json.
+"""
+
+from .index import TrackIndex
+from .local import LocalPlaylistStore
+from .m3u import Playlist, Track, readPlaylist, writePlaylist
+from .merge import mergePlaylists
+from .paths import PathMapper, convertPath, stripPrepend
+from .plex import PlexClient, PlexError
+from .sync import SyncEngine, SyncResult
+from .targets import MultiSync, MultiSyncResult
+from .util import PPPError
+
+vers = "v3.0.6"
@@ -0,0 +1,252 @@
+"""Backups of the local playlist directory."""
+
+import io                                    # character encoding
+import json                                  # for manifests and the ledger
+import os                                    # for folder and file management
+import shutil                                # for copying and deleting files
+import tarfile                               # for archived backups
+
+from .util import PPPError, br, fileHash, writeJson
+
+# Folders of local_backups used by the dedup and archive modes, everything
+# else in local_backups is a backup made by the copy mode
+STORE = ('objects', 'manifests', 'archives')
+
+
+def backupLocal(local_playlists, backup_dir, runtime, mode='copy', retention=10,
+                prune=True):
+    if mode == 'dedup':
+        backupDedup(local_playlists, backup_dir, runtime, retention, prune)
+    elif mode == 'archive':
+        backupArchive(local_playlists, backup_dir, runtime, retention, prune)
+    else:
+        backupCopy(local_playlists, backup_dir, runtime, retention, prune)
+
+    br()
+
+
+def backupCopy(local_playlists, backup_dir, runtime, retention, prune):
+    # Full copy of the local playlist directory, one folder per run
+    backups = [b for b in os.listdir(backup_dir) if b not in STORE]
+    backup_time = [b.replace('-', '') for b in backups]
+
+    while prune and len(backups) > retention:
+        print('INFO: Number of backups (%i) exceeds backup retention (%i)' %
+              (len(backups), retention))
+        oldest_backup = backup_time.index(min(backup_time))
+
+        # Delete oldest backup
+        shutil.rmtree(os.path.join(backup_dir, backups[oldest_backup]))
+        del backups[oldest_backup], backup_time[oldest_backup]
+
+        print('Deleted oldest backup')
+        br()
+
+    # Backup local playlists
+    try:
+        print('Backing up local playlists...\n')
+        shutil.copytree(local_playlists, os.path.join(backup_dir, runtime))
+        print('Backed up local playlists to ' + os.path.join(backup_dir, runtime))
+    except Exception as e:
+        raise PPPError('Directory not copied. %s' % e)
+
+    # Calculate backup size
+    size = sum(os.path.getsize(os.path.join(dirpath, filename)) for dirpath, dirnames,
+               filenames in os.walk(backup_dir) for filename in filenames) / 1024 / 1024
+    print('INFO: Your backups are currently taking up %sMB of space' %
+          round(size, 2))
+
+
+def backupManifests(backup_dir):
+    manifests = os.path.join(backup_dir, 'manifests')
+    if not os.path.isdir(manifests):
+        return []
+    return sorted(m[:-len('.json')] for m in os.listdir(manifests) if m.endswith('.json'))
+
+
+def loadManifest(backup_dir, name):
+    with io.open(os.path.join(backup_dir, 'manifests', name + '.json'), 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def backupObject(backup_dir, digest):
+    return os.path.join(backup_dir, 'objects', digest[:2], digest)
+
+
+def backupDedup(local_playlists, backup_dir, runtime, retention, prune):
+    # Content addressed backup. Each distinct file is stored once in
+    # local_backups/objects under its hash, and each run only adds a manifest
+    # mapping paths to hashes. A run where nothing changed adds nothing, and
+    # reads only the latest manifest.
+    objects = os.path.join(backup_dir, 'objects')
+    manifests_dir = os.path.join(backup_dir, 'manifests')
+    manifests = backupManifests(backup_dir)
+    changed = False
+
+    while prune and len(manifests) > retention:
+        print('INFO: Number of backups (%i) exceeds backup retention (%i)' %
+              (len(manifests), retention))
+        os.remove(os.path.join(manifests_dir, manifests.pop(0) + '.json'))
+        changed = True
+        print('Deleted oldest backup')
+        br()
+
+    latest = loadManifest(backup_dir, manifests[-1]) if manifests else {}
+    previous = latest.get('files', {})
+
+    try:
+        print('Backing up local playlists...\n')
+        files = {}
+        stored = 0
+        for root, _, filenames in os.walk(local_playlists):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, local_playlists)
+
+                # Files are only re-hashed if their mtime or size has changed
+                stat = os.stat(path)
+                entry = {'mtime': stat.st_mtime, 'size': stat.st_size}
+                old = previous.get(name)
+                if old and (old['mtime'], old['size']) == (entry['mtime'], entry['size']):
+                    entry['hash'] = old['hash']
+                else:
+                    entry['hash'] = fileHash(path)
+
+                object_path = backupObject(backup_dir, entry['hash'])
+                if not os.path.isfile(object_path):
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    shutil.copyfile(path, object_path + '.tmp')
+                    os.replace(object_path + '.tmp', object_path)
+                    stored += 1
+
+                files[name] = entry
+
+        if manifests and {n: e['hash'] for n, e in files.items()} == \
+                {n: e['hash'] for n, e in previous.items()}:
+            print('Local playlists unchanged since backup ' + manifests[-1])
+        else:
+            os.makedirs(manifests_dir, exist_ok=True)
+            latest = {'files': files}
+            writeJson(os.path.join(manifests_dir, runtime + '.json'), latest)
+            manifests.append(runtime)
+            changed = True
+            print('Backed up local playlists to %s (%d new files stored)' %
+                  (os.path.join(manifests_dir, runtime + '.json'), stored))
+    except Exception as e:
+        raise PPPError('Directory not copied. %s' % e)
+
+    # The latest manifest records the size of all backups, which only
+    # changes when a manifest is added or pruned
+    if not changed and 'backup_size' in latest:
+        print('INFO: Your backups are currently taking up %sMB of space' %
+              round(latest['backup_size'] / 1024 / 1024, 2))
+        return
+
+    # Remove objects no longer referenced by any manifest, and add up the
+    # size of the rest from the manifests
+    sizes = {}
+    for name in manifests:
+        for entry in loadManifest(backup_dir, name)['files'].values():
+            sizes[entry['hash']] = entry['size']
+
+    for dirpath, _, filenames in os.walk(objects, topdown=False):
+        for filename in filenames:
+            if filename not in sizes:
+                os.remove(os.path.join(dirpath, filename))
+        if dirpath != objects and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+    if manifests:
+        latest['backup_size'] = sum(sizes.values())
+        writeJson(os.path.join(manifests_dir, manifests[-1] + '.json'), latest)
+
+    print('INFO: Your backups are currently taking up %sMB of space' %
+          round(sum(sizes.values()) / 1024 / 1024, 2))
+
+
+def loadLedger(backup_dir):
+    # Sizes of each backup archive, so the total can be reported without
+    # touching the archives. Rebuilt from the archives if missing.
+    archives = os.path.join(backup_dir, 'archives')
+    try:
+        with io.open(os.path.join(archives, 'ledger.json'), 'r', encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        ledger = {}
+        if os.path.isdir(archives):
+            for archive in os.listdir(archives):
+                if archive.endswith('.tar.gz'):
+                    ledger[archive[:-len('.tar.gz')]] = os.path.getsize(
+                        os.path.join(archives, archive))
+        return ledger
+
+
+def saveLedger(backup_dir, ledger):
+    writeJson(os.path.join(backup_dir, 'archives', 'ledger.json'), ledger, indent=2)
+
+
+def backupArchive(local_playlists, backup_dir, runtime, retention, prune):
+    # Each run is a single compressed tar in local_backups/archives
+    archives_dir = os.path.join(backup_dir, 'archives')
+    ledger = loadLedger(backup_dir)
+    archives = sorted(ledger)
+
+    while prune and len(archives) > retention:
+        print('INFO: Number of backups (%i) exceeds backup retention (%i)' %
+              (len(archives), retention))
+        oldest_backup = archives.pop(0)
+        archive = os.path.join(archives_dir, oldest_backup + '.tar.gz')
+        if os.path.isfile(archive):
+            os.remove(archive)
+        del ledger[oldest_backup]
+        print('Deleted oldest backup')
+        br()
+
+    try:
+        print('Backing up local playlists...\n')
+        os.makedirs(archives_dir, exist_ok=True)
+        archive = os.path.join(archives_dir, runtime + '.tar.gz')
+        with tarfile.open(archive + '.tmp', 'w:gz') as tar:
+            tar.add(local_playlists, arcname='.')
+        os.replace(archive + '.tmp', archive)
+        ledger[runtime] = os.path.getsize(archive)
+        saveLedger(backup_dir, ledger)
+        print('Backed up local playlists to ' + archive)
+    except Exception as e:
+        raise PPPError('Directory not copied. %s' % e)
+
+    print('INFO: Your backups are currently taking up %sMB of space' %
+          round(sum(ledger.values()) / 1024 / 1024, 2))
+
+
+def listBackups(backup_dir):
+    copies = [b for b in os.listdir(backup_dir) if b not in STORE] \
+        if os.path.isdir(backup_dir) else []
+    return sorted(copies + backupManifests(backup_dir) + list(loadLedger(backup_dir)))
+
+
+def restoreBackup(local_playlists, backup_dir, name):
+    # Restores the files of a backup over the local playlist directory. Files
+    # which weren't in the backup are left alone.
+    if name in backupManifests(backup_dir):
+        print('Restoring local playlists from backup ' + name + '...\n')
+        for path, entry in loadManifest(backup_dir, name)['files'].items():
+            target_path = os.path.join(local_playlists, path)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            shutil.copyfile(backupObject(backup_dir, entry['hash']), target_path)
+    elif name in loadLedger(backup_dir):
+        print('Restoring local playlists from backup ' + name + '...\n')
+        with tarfile.open(os.path.join(backup_dir, 'archives', name + '.tar.gz'), 'r:gz') as tar:
+            # Reject absolute paths and links outside the target where supported
+            extract = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+            tar.extractall(local_playlists, **extract)
+    elif name in listBackups(backup_dir):
+        print('Restoring local playlists from backup ' + name + '...\n')
+        shutil.copytree(os.path.join(backup_dir, name), local_playlists,
+                        dirs_exist_ok=True)
+    else:
+        raise PPPError("Couldn't find backup '%s'. Available backups:\n  %s" %
+                       (name, '\n  '.join(listBackups(backup_dir))))
+
+    print('Restored local playlists from backup ' + name)
+    br()
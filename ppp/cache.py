@@ -0,0 +1,125 @@
+"""Cache of Plex playlist contents, so unchanged playlists aren't downloaded again."""
+
+import io                                    # character encoding
+import json                                  # for saving the cache
+import os                                    # for folder and file management
+import threading                             # for use from download workers
+from collections import OrderedDict          # for least recently used order
+
+from .util import writeJson
+
+
+class PlaylistCache:
+    # The tracks of each Plex playlist by key, saved to path, along with the
+    # updatedAt and leafCount the playlist had in the listing when it was
+    # downloaded, and the ETag and Last-Modified headers if Plex sent any.
+    # A playlist whose listing still matches is read from the cache instead
+    # of downloaded, otherwise the headers are sent back so Plex can answer
+    # 304 Not Modified.
+    #
+    # Playlists are kept least recently used first. Once the cache holds
+    # more than max_tracks tracks the least recently used are dropped, which
+    # also clears out playlists which no longer exist. Using a playlist only
+    # reorders it in memory, the order is saved along with the next
+    # playlist added, so a run served from the cache doesn't rewrite it.
+    #
+    # The cache belongs to a single server, it is discarded if server_url
+    # changes. refresh ignores the cached tracks (for -full), but playlists
+    # downloaded are still cached.
+
+    def __init__(self, path, server_url, max_tracks=500000, refresh=False):
+        self.path = path
+        self.server_url = server_url
+        self.max_tracks = max_tracks
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.playlists = OrderedDict()
+        self.changed = False
+        self.loaded = False
+
+    def load(self):
+        # Only loaded once, an engine keeps the cache between syncs
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with io.open(self.path, 'r', encoding='utf8') as f:
+                cache = json.load(f, object_pairs_hook=OrderedDict)
+        except Exception as e:
+            print('WARNING: Unable to load %s, downloading all playlists (%s)' % (self.path, e))
+            return
+        if cache.get('server_url') != self.server_url:
+            return
+        self.playlists = cache['playlists']
+
+    def save(self):
+        if not self.changed:
+            return
+        with self.lock:
+            self.evict()
+            try:
+                writeJson(self.path, {'server_url': self.server_url, 'playlists': self.playlists})
+                self.changed = False
+            except Exception as e:
+                print('WARNING: Unable to save %s (%s)' % (self.path, e))
+
+    def evict(self):
+        total = sum(len(entry['tracks']) for entry in self.playlists.values())
+        while self.playlists and total > self.max_tracks:
+            _, entry = self.playlists.popitem(last=False)
+            total -= len(entry['tracks'])
+
+    def use(self, key):
+        # Returns the entry for key, marked as most recently used
+        entry = self.playlists.get(key)
+        if entry:
+            self.playlists.move_to_end(key)
+        return entry
+
+    def get(self, playlist):
+        # The (title, tracks) of a playlist from the listing, or None if it
+        # isn't cached or has changed since. Plex versions which don't list
+        # updatedAt are always downloaded.
+        if self.refresh or playlist['updatedAt'] is None:
+            return None
+        with self.lock:
+            entry = self.playlists.get(playlist['key'])
+            if not entry or entry['updatedAt'] != playlist['updatedAt'] or \
+                    entry['leafCount'] != playlist['leafCount']:
+                return None
+            entry = self.use(playlist['key'])
+            return entry['title'], entry['tracks']
+
+    def headers(self, playlist):
+        # Conditional request headers for a playlist, if Plex sent validators
+        # with the cached copy
+        with self.lock:
+            entry = self.playlists.get(playlist['key'])
+        headers = {}
+        if entry and not self.refresh:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def revalidated(self, playlist):
+        # Plex answered 304 Not Modified, so the cached copy is still the
+        # playlist, whatever the listing says. Returns (title, tracks).
+        with self.lock:
+            entry = self.use(playlist['key'])
+            entry['updatedAt'] = playlist['updatedAt']
+            entry['leafCount'] = playlist['leafCount']
+            self.changed = True
+            return entry['title'], entry['tracks']
+
+    def put(self, playlist, title, tracks, validators):
+        with self.lock:
+            self.playlists[playlist['key']] = {
+                'updatedAt': playlist['updatedAt'], 'leafCount': playlist['leafCount'],
+                'etag': validators.get('etag'), 'last_modified': validators.get('last_modified'),
+                'title': title, 'tracks': tracks}
+            self.playlists.move_to_end(playlist['key'])
+            self.changed = True
@@ -0,0 +1,81 @@
+"""Loading and checking variables.json."""
+
+import io                                    # character encoding
+import json                                  # for variables.json
+import os                                    # for folder and file management
+
+from .targets import REQUIRED, targetVariables
+from .util import PPPError, writeJson
+
+def checkVariables(v):
+    # Everything wrong with v, an empty list if nothing is. Also checks the
+    # local playlists folder exists, which on a network share can be slow.
+    try:
+        targets = targetVariables(v)
+    except PPPError as e:
+        return [str(e)]
+
+    problems = []
+    if not os.path.isdir(v.get('local_playlists') or ''):
+        problems.append("local_playlists folder %s doesn't exist" % v.get('local_playlists'))
+
+    for name, target in targets:
+        where = ' for target ' + name if name else ''
+        missing = [key for key in REQUIRED if key not in target]
+        if missing:
+            problems.append('missing %s%s' % (', '.join(missing), where))
+            continue
+
+        if not str(target['server_url']).startswith(('http://', 'https://')):
+            problems.append('server_url%s must start with http:// or https://' % where)
+        if target['check_ssl'] not in ('True', 'False'):
+            problems.append('check_ssl%s must be "True" or "False"' % where)
+        for key in ('local_convert', 'plex_convert'):
+            if target[key] and target[key] not in ('w2u', 'u2w'):
+                problems.append('%s%s must be "w2u", "u2w" or false' % (key, where))
+
+        prepends = []
+        for key in ('local_prepend', 'plex_prepend'):
+            prepend = target[key]
+            prepend = [prepend] if isinstance(prepend, str) else prepend
+            if not isinstance(prepend, list) or not all(isinstance(p, str) for p in prepend):
+                problems.append('%s%s must be a path or a list of paths' % (key, where))
+            prepends.append(prepend)
+        if all(isinstance(p, list) for p in prepends) and len(prepends[0]) != len(prepends[1]):
+            problems.append('local_prepend and plex_prepend%s must have the same number of paths' %
+                            where)
+    return problems
+
+
+def loadVariables(path='variables.json'):
+    # Load and check variables.json. A file which passed is recorded by its
+    # mtime and size in path + '.checked', and isn't checked again until it
+    # changes, which keeps frequent runs (e.g. from cron) quick.
+    try:
+        stat = os.stat(path)
+        with io.open(path, 'r', encoding='utf8') as f:
+            v = json.load(f)
+    except ValueError as e:
+        raise PPPError('Unable to load %s, check it contains valid json (%s)' % (path, e))
+    except OSError as e:
+        raise PPPError('Unable to load %s (%s)' % (path, e))
+
+    checked = [stat.st_mtime_ns, stat.st_size]
+    try:
+        with io.open(path + '.checked', 'r', encoding='utf8') as f:
+            if json.load(f) == checked:
+                return v
+    except (OSError, ValueError):
+        pass
+
+    if not isinstance(v, dict):
+        raise PPPError('%s should hold a json object of variables' % path)
+    problems = checkVariables(v)
+    if problems:
+        raise PPPError('Problems in %s: %s' % (path, '; '.join(problems)))
+
+    try:
+        writeJson(path + '.checked', checked)
+    except OSError:
+        pass
+    return v
@@ -0,0 +1,143 @@
+"""Index of every track in the Plex music section, for matching moved files."""
+
+import io                                    # character encoding
+import json                                  # for saving the index
+import ntpath                                # for filenames of either path style
+import os                                    # for folder and file management
+import unicodedata                           # for comparing paths
+
+from .plex import PlexError
+from .util import writeJson
+
+
+def normalisePath(path):
+    # The same file can be written with either separator, in any case, and
+    # with accents composed or not
+    return unicodedata.normalize('NFC', path).replace('\\', '/').casefold()
+
+
+class TrackIndex:
+    # Every track in the music section, saved to path so later runs only
+    # fetch the tracks updated since. Each track is stored by ratingKey as
+    # [file, size, updatedAt], file being its Plex path. When a track's file changes
+    # (moved or renamed in Plex), its old path is kept as an alias so
+    # playlists still listing the old path resolve to the new one.
+    #
+    # Tracks are looked up in PPP path style through mapper, the Plex
+    # PathMapper, so the index doesn't depend on the prepends.
+
+    def __init__(self, path, section_id, mapper):
+        self.path = path
+        self.section_id = section_id
+        self.mapper = mapper
+
+        self.tracks = {}
+        self.aliases = {}
+        self.updated = 0
+        self.lookups = None
+        self.loaded = False
+
+    def load(self):
+        # Only loaded once, an engine keeps the index between syncs
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with io.open(self.path, 'r', encoding='utf8') as f:
+                index = json.load(f)
+        except Exception as e:
+            print('WARNING: Unable to load %s, rebuilding the track index (%s)' % (self.path, e))
+            return
+        if index.get('section_id') != self.section_id:
+            return
+        self.tracks = index['tracks']
+        self.aliases = index['aliases']
+        self.updated = index['updated']
+
+    def save(self):
+        try:
+            writeJson(self.path, {'section_id': self.section_id, 'updated': self.updated,
+                                  'tracks': self.tracks, 'aliases': self.aliases})
+        except Exception as e:
+            print('WARNING: Unable to save %s (%s)' % (self.path, e))
+
+    def refresh(self, plex, full=False):
+        # Fetch tracks updated since the last refresh, or every track if full.
+        # Tracks deleted from Plex stay in the index until the next full
+        # refresh, which does no harm as nothing will match them.
+        self.load()
+        full = full or not self.tracks
+        try:
+            tracks = plex.libraryTracks(self.section_id, None if full else self.updated)
+        except PlexError as e:
+            print('WARNING: Unable to update the track index, moved tracks may not be matched (%s)' % e)
+            return
+
+        # Plex returns tracks updated at or after self.updated, so the newest
+        # track comes back every time. Only tracks which differ from the
+        # index mean it needs rebuilding and saving.
+        previous_tracks = self.tracks
+        if full:
+            self.tracks, self.updated = {}, 0
+        changed = full
+        for track in tracks:
+            updated = int(track['updatedAt'] or 0)
+            entry = [track['file'], int(track['size'] or 0), updated]
+            previous = previous_tracks.get(track['ratingKey'])
+            if previous and previous[0] != track['file']:
+                self.aliases[previous[0]] = track['ratingKey']
+            changed = changed or previous != entry
+            self.tracks[track['ratingKey']] = entry
+            self.updated = max(self.updated, updated)
+
+        if changed:
+            self.lookups = None
+            self.save()
+
+    def build(self):
+        # Lookups from normalised path, and from filename and size, to the
+        # PPP path of each track, and from the PPP path to the ratingKey.
+        # Filenames shared by tracks of the same size can't be told apart and
+        # are left out.
+        self.load()
+        paths = {key: self.mapper.toPPP(track[0]) for key, track in self.tracks.items()}
+        by_path = {}
+        for file, key in self.aliases.items():
+            if key in paths:
+                by_path[normalisePath(self.mapper.toPPP(file))] = paths[key]
+        by_file = {}
+        keys = {}
+        for key, (_, size, _) in self.tracks.items():
+            by_path[normalisePath(paths[key])] = paths[key]
+            keys[paths[key]] = key
+            name = (normalisePath(ntpath.basename(paths[key])), size)
+            by_file[name] = None if name in by_file else paths[key]
+        self.lookups = by_path, by_file, keys
+
+    def resolve(self, path, local_path=None):
+        # Returns the PPP path Plex has for the track at path (PPP path
+        # style), or path itself if the track isn't in Plex. If the path
+        # isn't known, the track is matched by filename and size when the
+        # local file at local_path can be read.
+        if self.lookups is None:
+            self.build()
+        by_path, by_file, _ = self.lookups
+
+        resolved = by_path.get(normalisePath(path))
+        if resolved is None and local_path:
+            try:
+                size = os.path.getsize(local_path)
+            except OSError:
+                size = None
+            if size is not None:
+                resolved = by_file.get((normalisePath(ntpath.basename(path)), size))
+        return resolved or path
+
+    def ratingKey(self, path):
+        # The ratingKey of the track at path (PPP path style), or None if it
+        # isn't in Plex
+        if self.lookups is None:
+            self.build()
+        return self.lookups[2].get(self.resolve(path))
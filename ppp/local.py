@@ -0,0 +1,103 @@
+"""Reading and writing the local playlist directory."""
+
+import os                                    # for folder and file management
+import threading                             # for sharing between sync targets
+from concurrent.futures import ThreadPoolExecutor  # for concurrent reads
+
+from .m3u import EXTENSIONS, playlistName, readPlaylist, writePlaylist
+
+
+class LocalPlaylistStore:
+    # The .m3u and .m3u8 playlists in a local directory and its
+    # subdirectories. Playlists are identified by filename, as Plex has no
+    # folders, with .m3u8 playlists listed under their .m3u name.
+    # Folders are listed and playlists read on a pool of workers, as on a
+    # network share the time is mostly spent waiting on each request.
+
+    def __init__(self, directory, workers=8):
+        self.directory = directory
+        self.workers = workers
+
+        # Parsed playlists by path, with the (mtime, size) they were read at
+        self.cache = {}
+
+        # When several sync targets share the store they take turns to read,
+        # merge and write back playlists while holding lock. backed_up is the
+        # runtime of the last backup, so each run is only backed up once.
+        self.lock = threading.Lock()
+        self.backed_up = None
+
+    def listFolder(self, folder):
+        # Returns the playlists and subfolders in folder, like os.walk()
+        # unreadable folders are ignored and symlinked folders aren't followed
+        files, folders = [], []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            folders.append(entry.path)
+                    elif entry.name.endswith(EXTENSIONS):
+                        files.append(entry)
+        except OSError:
+            pass
+        return files, folders
+
+    def paths(self):
+        # Map each playlist filename to every path it was found at, in the
+        # same order as os.walk(). Each level of folders is listed at once.
+        listings = {}
+        level = [self.directory]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while level:
+                for folder, listing in zip(level, pool.map(self.listFolder, level)):
+                    listings[folder] = listing
+                level = [sub for folder in level for sub in listings[folder][1]]
+
+        paths = {}
+        pending = [self.directory]
+        while pending:
+            files, folders = listings[pending.pop()]
+            for entry in files:
+                paths.setdefault(playlistName(entry.name), []).append(entry.path)
+            pending.extend(reversed(folders))
+        return paths
+
+    def read(self, path):
+        # Files are only read again if their mtime or size has changed
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self.cache.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        playlist = readPlaylist(path)
+        self.cache[path] = (signature, playlist)
+        return playlist
+
+    def load(self, paths):
+        # Read the playlists in paths, as returned by paths(). If a filename
+        # is found in more than one folder, the last one found is used.
+        filenames = list(paths)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            playlists = list(pool.map(lambda filename: self.read(paths[filename][-1]),
+                                      filenames))
+
+        for filename in filenames:
+            print(('Loading local playlist: ' + paths[filename][-1]))
+        return dict(zip(filenames, playlists))
+
+    def write(self, filename, tracks, paths, header=(), footer=()):
+        # Write a playlist to each of paths, or to the root directory if it
+        # is new. Files which already match are left alone. Returns the paths
+        # written and the paths left unchanged.
+        targets = paths.get(filename, [os.path.join(self.directory, filename)])
+        written, unchanged = [], []
+        for target_path in targets:
+            if writePlaylist(target_path, tracks, header, footer):
+                print('Copying updated playlist to local playlists: ' + target_path)
+                written.append(target_path)
+                self.cache.pop(target_path, None)
+            else:
+                unchanged.append(target_path)
+        return written, unchanged
@@ -0,0 +1,142 @@
+"""Reading and writing extended M3U (.m3u and .m3u8) playlists."""
+
+import codecs                                # for byte order marks
+import io                                    # character encoding
+import os                                    # for replacing files
+import sys                                   # for interning strings
+
+EXTENSIONS = ('.m3u', '.m3u8')
+
+# Lines which describe the whole playlist rather than the track after them
+HEADER_TAGS = ('#EXTM3U', '#PLAYLIST:', '#EXTENC:')
+
+
+def playlistName(filename):
+    # Playlists are identified by filename, as Plex has no folders. A .m3u8
+    # playlist is the same playlist as a .m3u one with the same title.
+    return filename[:-1] if filename.endswith('.m3u8') else filename
+
+
+class Track:
+    # A single playlist entry. info is the #EXTINF line without the tag (e.g.
+    # '215,Artist - Title'), tags holds any other # lines directly before the
+    # track. Tracks are compared by path alone, so the same file matches
+    # whether or not either side has its metadata.
+    #
+    # There can be hundreds of thousands of these across all playlists, so
+    # they use __slots__ and interned strings to keep each one small.
+    __slots__ = ('path', 'info', 'tags')
+
+    def __init__(self, path, info=None, tags=()):
+        self.path = sys.intern(path)
+        self.info = sys.intern(info) if info is not None else None
+        self.tags = tuple(sys.intern(tag) for tag in tags)
+
+    def withPath(self, path):
+        track = Track.__new__(Track)
+        track.path, track.info, track.tags = path, self.info, self.tags
+        return track
+
+    def lines(self):
+        lines = list(self.tags)
+        if self.info is not None:
+            lines.append('#EXTINF:' + self.info)
+        lines.append(self.path)
+        return lines
+
+    def __eq__(self, other):
+        return isinstance(other, Track) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return 'Track(%r)' % self.path
+
+
+class Playlist:
+    # A parsed playlist. header holds the playlist level tags at the start
+    # (e.g. #EXTM3U), footer any # lines after the last track.
+    __slots__ = ('header', 'tracks', 'footer')
+
+    def __init__(self, header=(), tracks=(), footer=()):
+        self.header = tuple(header)
+        self.tracks = list(tracks)
+        self.footer = tuple(footer)
+
+
+def parsePlaylist(lines):
+    header, tracks, pending = [], [], []
+    info = None
+    for line in lines:
+        if not line.strip():
+            continue
+        if line.startswith('#'):
+            if not tracks and not pending and info is None and line.startswith(HEADER_TAGS):
+                header.append(line)
+            elif line.startswith('#EXTINF:'):
+                info = line[len('#EXTINF:'):]
+            else:
+                pending.append(line)
+        else:
+            tracks.append(Track(line, info, pending))
+            info, pending = None, []
+
+    if info is not None:
+        pending.append('#EXTINF:' + info)
+    return Playlist(header, tracks, pending)
+
+
+def readPlaylist(path):
+    # utf-8-sig also reads files starting with a byte order mark, as written
+    # by some Windows players
+    with io.open(path, 'r', encoding='utf-8-sig') as f:
+        return parsePlaylist(f.read().splitlines())
+
+
+def renderPlaylist(tracks, header=(), footer=()):
+    # Tracks may be Track objects or plain paths. #EXTM3U is added if any
+    # track has metadata, as players only read it in extended playlists.
+    tracks = [track if isinstance(track, Track) else Track(track) for track in tracks]
+    header = list(header)
+    if '#EXTM3U' not in header and any(t.info is not None or t.tags for t in tracks):
+        header.insert(0, '#EXTM3U')
+
+    lines = header + [line for track in tracks for line in track.lines()] + list(footer)
+    return ''.join(line + '\n' for line in lines)
+
+
+def writePlaylist(path, tracks, header=(), footer=()):
+    # The file is left alone if it already has the same contents, so its
+    # mtime doesn't change and players watching the folder don't rescan it.
+    # Otherwise it is written in full then moved into place, so a crash never
+    # leaves half a playlist. Returns True if the file was written.
+    data = renderPlaylist(tracks, header, footer).replace('\n', os.linesep).encode('utf8')
+
+    # The current file is only read in full if the size matches. A byte
+    # order mark at the start of it is kept.
+    try:
+        with io.open(path, 'rb') as f:
+            start = f.read(len(codecs.BOM_UTF8))
+            if start == codecs.BOM_UTF8:
+                data = codecs.BOM_UTF8 + data
+            if os.fstat(f.fileno()).st_size == len(data) and start + f.read() == data:
+                return False
+    except OSError:
+        pass
+
+    temp_path = path + '.tmp'
+    try:
+        with io.open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return True
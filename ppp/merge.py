@@ -0,0 +1,36 @@
+"""Merging of local and Plex playlists."""
+
+from collections import Counter              # for merging playlists
+
+
+def mergePlaylists(local_tracks, plex_tracks):
+    # Local tracks come first (minus m3u tags beginning with #), followed by
+    # Plex tracks which aren't already in the local playlist. Duplicates are
+    # matched one for one, so a track listed twice locally hides at most two
+    # copies of it in Plex. Counting instead of list.remove() keeps this
+    # linear in the length of both playlists.
+    #
+    # Tracks may be plain paths or Track objects, which match by path so
+    # local tracks keep their #EXTINF metadata.
+    remaining = Counter(local_tracks)
+    merged = [line for line in local_tracks if not str(line).startswith('#')]
+    for line in plex_tracks:
+        if remaining[line]:
+            remaining[line] -= 1
+        else:
+            merged.append(line)
+    return merged
+
+
+def addedTracks(current, target):
+    # Tracks in target which current is missing, with duplicates matched one
+    # for one, in their order in target. A merged playlist holds every track
+    # of both sides, so this is all that changes: tracks are never removed.
+    remaining = Counter(current)
+    add = []
+    for line in target:
+        if remaining[line]:
+            remaining[line] -= 1
+        else:
+            add.append(line)
+    return add
@@ -0,0 +1,102 @@
+"""Timings and counts for each sync, for monitoring."""
+
+import json                                  # for the summary
+import threading                             # for counting from worker threads
+import time                                  # for timing stages
+from contextlib import contextmanager        # for timing stages
+
+from .util import writeFile
+
+
+class Metrics:
+    # Collected during a single sync. Stages are timed in the order they
+    # run, counts may be added to from any thread.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.seconds = None
+        self.stages = {}
+        self.counts = {}
+        self.fetches = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.time() - start
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def fetched(self, title, seconds):
+        # Time taken to download a single Plex playlist, including all pages
+        with self.lock:
+            self.fetches[title] = seconds
+
+    def finish(self):
+        self.seconds = time.time() - self.start
+
+    def summary(self, result, completed=True):
+        return {'runtime': result.runtime,
+                'completed': completed,
+                'ok': completed and result.ok,
+                'seconds': self.seconds,
+                'stages': self.stages,
+                'counts': self.counts,
+                'playlists': {'skipped': len(result.skipped),
+                              'new_plex': len(result.new_plex),
+                              'new_local': len(result.new_local),
+                              'merged': len(result.merged),
+                              'download_errors': len(result.download_errors),
+                              'uploaded': len(result.uploaded) - len(result.failed),
+                              'failed': len(result.failed),
+                              'copied': len(result.copied),
+                              'up_to_date': len(result.up_to_date)},
+                'fetch_seconds': self.fetches}
+
+
+def saveSummary(path, summary):
+    try:
+        writeFile(path, json.dumps(summary, indent=2) + '\n')
+    except Exception as e:
+        print('WARNING: Unable to save %s (%s)' % (path, e))
+
+
+def prometheusText(summary):
+    # Metrics in the Prometheus text format, for the node exporter's textfile
+    # collector. All are gauges describing the most recent sync, labelled with
+    # the target when syncing to more than one.
+    metrics = [
+        ('ppp_last_run_timestamp_seconds', 'Time the last sync finished', [('', time.time())]),
+        ('ppp_last_run_success', 'Whether the last sync completed without errors',
+         [('', int(summary['ok']))]),
+        ('ppp_last_run_seconds', 'Time taken by the last sync', [('', summary['seconds'] or 0)]),
+        ('ppp_stage_seconds', 'Time taken by each stage of the last sync',
+         [('stage="%s"' % name, seconds) for name, seconds in summary['stages'].items()]),
+        ('ppp_count', 'Requests, bytes and tracks handled by the last sync',
+         [('name="%s"' % name, n) for name, n in summary['counts'].items()]),
+        ('ppp_playlists', 'Playlists handled by the last sync, by what happened to them',
+         [('result="%s"' % name, n) for name, n in summary['playlists'].items()]),
+    ]
+
+    target = ['target="%s"' % summary['target']] if summary.get('target') else []
+
+    lines = []
+    for name, description, samples in metrics:
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s gauge' % name)
+        for labels, value in samples:
+            labels = ','.join(target + ([labels] if labels else []))
+            lines.append('%s%s %s' % (name, '{%s}' % labels if labels else '', repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def savePrometheus(path, summary):
+    try:
+        writeFile(path, prometheusText(summary))
+    except Exception as e:
+        print('WARNING: Unable to save %s (%s)' % (path, e))
@@ -0,0 +1,93 @@
+"""Conversion between local, Plex and PPP path styles."""
+
+# Largest number of paths PathMapper remembers in each direction before
+# starting again, to bound memory in long-running watch mode
+CACHE_SIZE = 500000
+
+
+def convertPath(path, convert, invert):
+    if convert == False:
+        return path
+    elif (convert == 'w2u' and not invert) or (convert == 'u2w' and invert):
+        return path.replace("/", "\\")
+    else:
+        return path.replace("\\", "/")
+
+
+def stripPrepend(path, prepend, invert):
+    if not invert:
+        return path[len(prepend):] if path.startswith(prepend) else path
+    else:
+        return prepend + path
+
+
+class PathMapper:
+    # Maps tracks between one side's paths (local or Plex) and PPP path style.
+    # prepend is the path to be ignored, or a list of them when music is kept
+    # under more than one root. The nth local prepend pairs with the nth Plex
+    # prepend. Tracks under the first are stored in PPP path style as their
+    # path relative to it (as with a single prepend), tracks under the others
+    # are marked with the index of their prepend, e.g. '<1>Artist/Track.mp3'.
+    # convert is 'w2u', 'u2w' or False as saved in variables.json.
+    #
+    # Results are cached, as the same track usually appears in many playlists.
+
+    def __init__(self, prepend, convert):
+        prepends = [prepend] if isinstance(prepend, str) else list(prepend)
+        self.prepends = prepends
+        self.convert = convert
+
+        # Longest prepend first, so a music root inside another one wins
+        self.rules = sorted(((p, '<%d>' % i if i else '') for i, p in enumerate(prepends)),
+                            key=lambda rule: len(rule[0]), reverse=True)
+        self.markers = {'<%d>' % i: p for i, p in enumerate(prepends) if i}
+
+        # Separators as (old, new) for each direction
+        if convert == False:
+            self.to_sep = self.from_sep = None
+        elif convert == 'w2u':
+            self.to_sep, self.from_sep = ('/', '\\'), ('\\', '/')
+        else:
+            self.to_sep, self.from_sep = ('\\', '/'), ('/', '\\')
+
+        self.to_cache = {}
+        self.from_cache = {}
+
+    def toPPP(self, path):
+        cached = self.to_cache.get(path)
+        if cached is not None:
+            return cached
+
+        converted = path
+        for prepend, marker in self.rules:
+            if path.startswith(prepend):
+                converted = marker + path[len(prepend):]
+                break
+        if self.to_sep:
+            converted = converted.replace(*self.to_sep)
+
+        if len(self.to_cache) >= CACHE_SIZE:
+            self.to_cache.clear()
+        self.to_cache[path] = converted
+        return converted
+
+    def fromPPP(self, path):
+        cached = self.from_cache.get(path)
+        if cached is not None:
+            return cached
+
+        prepend = self.prepends[0]
+        converted = path
+        if path.startswith('<'):
+            marker = path[:path.find('>') + 1]
+            if marker in self.markers:
+                prepend = self.markers[marker]
+                converted = path[len(marker):]
+        if self.from_sep:
+            converted = converted.replace(*self.from_sep)
+        converted = prepend + converted
+
+        if len(self.from_cache) >= CACHE_SIZE:
+            self.from_cache.clear()
+        self.from_cache[path] = converted
+        return converted
@@ -0,0 +1,144 @@
+"""Pipelined sync, where each playlist is merged and sent as soon as it arrives."""
+
+import asyncio                               # for the pipeline
+
+from .plex import printPush, printUpload
+from .state import plexPlaylistsByName
+from .util import PPPError
+
+# Marks the end of a queue
+DONE = None
+
+
+async def fetchStage(engine, result, playlist, playlists, requests, merge_queue):
+    # Download one Plex playlist, a page at a time if it is long, and queue
+    # it for merging. playlists limits how many playlists are in flight,
+    # and is held until the playlist is queued, so downloads wait while the
+    # merge falls behind instead of piling up in memory.
+    async with playlists:
+        async def fetchPage(page):
+            async with requests:
+                return await asyncio.to_thread(engine.plex.fetchPage, page)
+
+        cached = engine.plex.cachedPlaylist(playlist)
+        if cached:
+            key, title, tracks, error = cached
+        else:
+            pages = engine.plex.playlistPages(playlist, engine.page_size)
+            parts = await asyncio.gather(*[fetchPage(page) for page in pages])
+            key, title, tracks, error = engine.plex.stitchPlaylist(playlist, parts)
+
+        if error:
+            print('ERROR: Failed to download Plex playlist %s: %s' % (key, error))
+            result.download_errors.append((key, error))
+            return
+
+        await merge_queue.put((title + '.m3u', engine.plexTracks(result, title, tracks)))
+
+
+async def mergeStage(engine, result, local_lists, merge_queue, push_queue, push_workers):
+    # Merge each playlist as it arrives and queue it to be sent
+    while True:
+        item = await merge_queue.get()
+        if item is DONE:
+            for _ in range(push_workers):
+                await push_queue.put(DONE)
+            return
+
+        filename, plex_tracks = item
+        local_tracks = local_lists.get(filename)
+        with result.metrics.stage('merge'):
+            merged = engine.mergePlaylist(result, filename, plex_tracks, local_tracks)
+
+        if engine.nocleanup:
+            engine.dumpDebug({filename: plex_tracks} if plex_tracks is not None else {},
+                             {filename: local_tracks} if local_tracks is not None else {},
+                             {filename: merged})
+
+        await push_queue.put((filename, merged, plex_tracks))
+
+
+def pushPlaylist(engine, filename, tracks, plex_tracks, plex_playlists):
+    # Send one merged playlist to Plex, runs in a worker thread
+    if engine.push_mode == 'items':
+        try:
+            name, playlist, add = engine.itemChanges(
+                filename, tracks, plex_tracks, plex_playlists.get(filename))
+        except PPPError as e:
+            return filename, False, 0, 0.0, str(e)
+        return (name,) + engine.plex.pushPlaylist(
+            name[:-len('.m3u')], playlist, add, engine.batch_size,
+            engine.timeout, engine.retries)
+
+    return (filename,) + engine.plex.uploadPlaylist(
+        engine.v['section_id'], engine.writePlexPlaylist(filename, tracks),
+        engine.timeout, engine.retries)
+
+
+async def pushStage(engine, result, plex_playlists, local_playlists, local_paths, push_queue):
+    # Send each merged playlist to Plex, then write it back locally
+    while True:
+        item = await push_queue.get()
+        if item is DONE:
+            return
+
+        filename, tracks, plex_tracks = item
+        pushed = await asyncio.to_thread(
+            pushPlaylist, engine, filename, tracks, plex_tracks, plex_playlists)
+        (printPush if engine.push_mode == 'items' else printUpload)(pushed)
+        result.uploaded.append(pushed)
+
+        await asyncio.to_thread(
+            engine.copyBack, result, filename, tracks, local_playlists, local_paths)
+
+
+async def pipeline(engine, result, changed, local_lists, local_playlists, local_paths):
+    # Bounded queues between the stages keep at most a few playlists
+    # waiting at each step
+    merge_queue = asyncio.Queue(maxsize=engine.workers)
+    push_queue = asyncio.Queue(maxsize=engine.upload_workers)
+    playlists = asyncio.Semaphore(engine.workers)
+    requests = asyncio.Semaphore(engine.workers)
+
+    # As in the staged sync, a title listed twice in Plex is merged with the
+    # last of them, and maps to None in plex_playlists so its items aren't
+    # pushed to either
+    downloads = {playlist['title'] + '.m3u': playlist for playlist in changed}
+    plex_playlists = plexPlaylistsByName(changed)
+    local_only = sorted(set(local_lists) - set(downloads))
+
+    print("Syncing %d playlists, downloading %d at once and sending %d at once..." %
+          (len(downloads) + len(local_only), engine.workers, engine.upload_workers))
+
+    async def produce():
+        for filename in local_only:
+            await merge_queue.put((filename, None))
+        await asyncio.gather(*[fetchStage(engine, result, playlist, playlists, requests, merge_queue)
+                               for playlist in downloads.values()])
+        await merge_queue.put(DONE)
+
+    tasks = [asyncio.create_task(produce()),
+             asyncio.create_task(mergeStage(engine, result, local_lists, merge_queue,
+                                            push_queue, engine.upload_workers))]
+    tasks += [asyncio.create_task(pushStage(engine, result, plex_playlists, local_playlists,
+                                            local_paths, push_queue))
+              for _ in range(engine.upload_workers)]
+
+    # If any stage fails the others would wait on it forever, so stop them
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()
+
+
+def runPipeline(engine, result, changed, local_lists, local_playlists, local_paths):
+    # Sync each playlist through download, merge, upload and copy back as
+    # soon as it is ready, so slow requests for one playlist overlap with
+    # work on the others. Unlike the staged sync, a playlist which fails to
+    # download only holds back that playlist.
+    asyncio.run(pipeline(engine, result, changed, local_lists, local_playlists, local_paths))
+    result.new_plex.sort()
+    result.new_local.sort()
+    result.merged.sort()
+    result.uploaded.sort()
@@ -0,0 +1,424 @@
+"""Requests to the Plex server."""
+
+import time                                  # for retry backoff
+import urllib                                # for Plex POST
+from collections import OrderedDict          # url ordering
+from concurrent.futures import ThreadPoolExecutor  # for concurrent requests
+from xml.etree import ElementTree            # for xml
+
+from .util import PPPError, br
+
+
+class PlexError(PPPError):
+    pass
+
+
+def iterPlaylist(stream):
+    # Parses a playlist response as it is downloaded. The attributes of the
+    # MediaContainer are yielded first, followed by the file of each track as
+    # it arrives. Tracks are cleared once read, so the tree never grows
+    # beyond a single track however long the playlist is.
+    context = ElementTree.iterparse(stream, events=('start', 'end'))
+    _, root = next(context)
+    yield dict(root.attrib)
+    for event, document in context:
+        if event == 'end' and document.tag == 'Track':
+            yield document[0][0].get('file')
+            root.clear()
+
+
+def iterTracks(stream):
+    # Parses a library listing as it is downloaded, like iterPlaylist(), and
+    # yields the ratingKey, updatedAt, file and size of each track
+    context = ElementTree.iterparse(stream, events=('start', 'end'))
+    _, root = next(context)
+    for event, document in context:
+        if event == 'end' and document.tag == 'Track':
+            part = document.find('Media/Part')
+            if part is not None:
+                yield {'ratingKey': document.get('ratingKey'),
+                       'updatedAt': document.get('updatedAt'),
+                       'file': part.get('file'),
+                       'size': part.get('size')}
+            root.clear()
+
+
+def parsePlaylist(root):
+    title = root.get("title")
+    playlist = []
+    for document in root.findall("Track"):
+        playlist.append(document[0][0].get('file'))
+    return title, playlist
+
+
+def printUpload(upload):
+    name, ok, attempts, seconds, error = upload
+    if ok:
+        print('Sent updated playlist to Plex: %s (%.1fs%s)' %
+              (name, seconds, ', %d attempts' % attempts if attempts > 1 else ''))
+    else:
+        print('ERROR: Failed to send playlist to Plex: %s (%d attempts) %s' %
+              (name, attempts, error))
+
+
+def printPush(push):
+    name, ok, sent, seconds, error = push
+    if not ok:
+        print('ERROR: Failed to send playlist to Plex: %s (%d requests) %s' %
+              (name, sent, error))
+    elif sent:
+        print('Sent changes to Plex: %s (%.1fs, %d requests)' % (name, seconds, sent))
+    else:
+        print('Plex playlist already up to date: ' + name)
+
+
+class PlexClient:
+    # All requests to one Plex server go through a single pooled session, so
+    # connections are kept alive and reused instead of reopened each time.
+    # pool_block caps the number of simultaneous connections to the host.
+
+    def __init__(self, server_url, plex_token, check_ssl=True, connections=4):
+        self.server_url = server_url
+        self.plex_token = plex_token
+        self.check_ssl = check_ssl
+        self.machine_identifier = None
+
+        # Metrics of the sync in progress, if any
+        self.metrics = None
+
+        # PlaylistCache of downloaded playlists, if any
+        self.cache = None
+
+        # requests is slow to import, so it is only imported once PPP is
+        # about to talk to Plex
+        import requests                              # HTTP POST requests
+        from requests.adapters import HTTPAdapter    # for connection pooling
+
+        self.session = requests.Session()
+        self.session.verify = check_ssl
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections,
+                              pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def hideToken(self, text):
+        return str(text).replace(self.plex_token, "***********")
+
+    def record(self, resp, received=None):
+        # Count a request and the bytes received for it
+        if self.metrics:
+            self.metrics.count('requests')
+            self.metrics.count('bytes_received', len(resp.content) if received is None else received)
+
+    def get(self, url):
+        print("URL: " + self.hideToken(url))
+        try:
+            resp = self.session.get(url, timeout=30)
+        except Exception as e:
+            raise PlexError("Issue encountered with request. " + self.hideToken(e))
+        self.record(resp)
+
+        if not resp.ok:
+            raise PlexError('Request failed. Return code: %d Reason: %s' %
+                            (resp.status_code, resp.reason))
+
+        print("Request was successful.")
+        br()
+        return ElementTree.fromstring(resp.text)
+
+    def sections(self):
+        print("Requesting section info from Plex...")
+        url = self.server_url + "/library/sections/all?X-Plex-Token=" + self.plex_token
+        root = self.get(url)
+        sections = []
+        for document in root.findall("Directory"):
+            if document.get('type') == "artist":
+                sections.append((document.get('key'), document.get('title').strip()))
+        return sections
+
+    def playlistListing(self):
+        print("Requesting playlists from Plex...")
+        url = self.server_url + "/playlists/?X-Plex-Token=" + self.plex_token
+        root = self.get(url)
+        listing = []
+        for document in root.findall("Playlist"):
+            if document.get('smart') == "0" and document.get('playlistType') == "audio":
+                listing.append({'key': document.get('key'),
+                                'ratingKey': document.get('ratingKey'),
+                                'title': document.get('title'),
+                                'updatedAt': document.get('updatedAt'),
+                                'leafCount': document.get('leafCount')})
+        print("Found " + str(len(listing)) + " playlists.")
+        br()
+        return listing
+
+    def playlistKeys(self):
+        return [playlist['key'] for playlist in self.playlistListing()]
+
+    def playlist(self, key):
+        print("Requesting playlist data from Plex...")
+        url = self.server_url + key + "?X-Plex-Token=" + self.plex_token
+        title, playlist = parsePlaylist(self.get(url))
+        print("Found playlist: " + title)
+        print("Found " + str(len(playlist)) + " songs.")
+        return title, playlist
+
+    def fetchPlaylist(self, key, start=None, size=None, headers=None):
+        # Fetches a playlist, or a single page of it if start and size are
+        # given. Runs in a worker thread so it doesn't print. Returns (title,
+        # playlist, validators, modified), validators being the ETag and
+        # Last-Modified headers of the response. modified is False, and title
+        # and playlist None, if headers made the request conditional and the
+        # playlist hasn't changed.
+        url = self.server_url + key + "?X-Plex-Token=" + self.plex_token
+        if size is not None:
+            url += "&X-Plex-Container-Start=%d&X-Plex-Container-Size=%d" % (start, size)
+        with self.session.get(url, headers=headers, timeout=30, stream=True) as resp:
+            validators = {'etag': resp.headers.get('ETag'),
+                          'last_modified': resp.headers.get('Last-Modified')}
+            if resp.status_code == 304:
+                self.record(resp, 0)
+                return None, None, validators, False
+            if not resp.ok:
+                raise PlexError('Return code: %d Reason: %s' %
+                                (resp.status_code, resp.reason))
+            resp.raw.decode_content = True
+            tracks = iterPlaylist(resp.raw)
+            title = next(tracks).get('title')
+            playlist = list(tracks)
+            self.record(resp, resp.raw.tell())
+        return title, playlist, validators, True
+
+    def libraryTracks(self, section_id, since=None):
+        # Every track in the music section, or only those updated at or after
+        # the timestamp since. Parsed as it arrives, as a large library can be
+        # hundreds of thousands of tracks.
+        print("Requesting %s from Plex..." %
+              ("tracks updated since the last run" if since else "all tracks"))
+        url = self.server_url + "/library/sections/%s/all?type=10&X-Plex-Token=%s" % (
+            section_id, self.plex_token)
+        if since:
+            # >>= is Plex's greater than filter
+            url += "&updatedAt%3E%3E=" + str(since - 1)
+        print("URL: " + self.hideToken(url))
+        try:
+            with self.session.get(url, timeout=300, stream=True) as resp:
+                if not resp.ok:
+                    raise PlexError('Request failed. Return code: %d Reason: %s' %
+                                    (resp.status_code, resp.reason))
+                resp.raw.decode_content = True
+                tracks = list(iterTracks(resp.raw))
+                self.record(resp, resp.raw.tell())
+        except PlexError:
+            raise
+        except Exception as e:
+            raise PlexError("Issue encountered with request. " + self.hideToken(e))
+
+        print("Found " + str(len(tracks)) + " tracks.")
+        br()
+        return tracks
+
+    def fetchPage(self, page):
+        # Fetch one page as listed by playlistPages(). Returns
+        # ((title, tracks, validators, modified), error, seconds).
+        start = time.time()
+        try:
+            return self.fetchPlaylist(*page), None, time.time() - start
+        except Exception as e:
+            return None, self.hideToken(e), time.time() - start
+
+    def playlistPages(self, playlist, page_size=5000):
+        # Playlists with more than page_size tracks are split into pages.
+        # Whole playlists are requested conditionally if they are cached.
+        count = int(playlist['leafCount'] or 0)
+        if page_size and count > page_size:
+            return [(playlist['key'], start, page_size) for start in range(0, count, page_size)]
+        return [(playlist['key'], None, None, self.cache.headers(playlist) if self.cache else None)]
+
+    def cachedPlaylist(self, playlist):
+        # The playlist from the cache as (key, title, playlist, error) like
+        # stitchPlaylist(), or None if it needs downloading
+        cached = self.cache.get(playlist) if self.cache else None
+        if cached is None:
+            return None
+        if self.metrics:
+            self.metrics.count('playlists_cached')
+        title, tracks = cached
+        return playlist['key'], title, tracks, None
+
+    def stitchPlaylist(self, playlist, parts):
+        # Join the fetched pages of a playlist back together in order, and
+        # cache the result. Returns (key, title, playlist, error).
+        if self.metrics:
+            self.metrics.fetched(playlist['title'], sum(seconds for _, _, seconds in parts))
+        errors = [error for _, error, _ in parts if error]
+        if errors:
+            return playlist['key'], None, None, errors[0]
+
+        title, _, validators, modified = parts[0][0]
+        if not modified:
+            # Not modified since it was cached
+            if self.metrics:
+                self.metrics.count('playlists_cached')
+            title, tracks = self.cache.revalidated(playlist)
+            return playlist['key'], title, tracks, None
+
+        tracks = [track for (_, page, _, _), _, _ in parts for track in page]
+
+        if playlist['leafCount'] is not None and len(tracks) != int(playlist['leafCount']):
+            return (playlist['key'], None, None,
+                    'Expected %s tracks but received %d, was the playlist changed during the sync?' %
+                    (playlist['leafCount'], len(tracks)))
+
+        if self.cache:
+            self.cache.put(playlist, title, tracks, validators)
+        return playlist['key'], title, tracks, None
+
+    def playlists(self, listing, workers=4, page_size=5000):
+        # Download all playlists in listing concurrently. Playlists with more
+        # than page_size tracks are split into pages, which are downloaded
+        # concurrently too and stitched back together in order. Returns
+        # (key, title, playlist, error) for each playlist, in the same order
+        # as listing regardless of which request finishes first. Playlists
+        # unchanged since they were cached aren't downloaded.
+        cached = [self.cachedPlaylist(playlist) for playlist in listing]
+        download = [playlist for playlist, hit in zip(listing, cached) if hit is None]
+        pages = [self.playlistPages(playlist, page_size) for playlist in download]
+
+        if len(download) < len(listing):
+            print("Using %d unchanged playlists from the cache" % (len(listing) - len(download)))
+        print("Requesting %d playlists (%d pages) from Plex using %d workers..." %
+              (len(download), sum(len(p) for p in pages), workers))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            fetched = iter(list(pool.map(self.fetchPage, [page for p in pages for page in p])))
+
+        downloaded = iter([self.stitchPlaylist(playlist, [next(fetched) for _ in playlist_pages])
+                           for playlist, playlist_pages in zip(download, pages)])
+        results = [hit or next(downloaded) for hit in cached]
+
+        br()
+        return results
+
+    def send(self, method, url, params, timeout=300, retries=3):
+        # Sends a request which changes something in Plex. Server errors
+        # (5xx) and dropped connections are retried with exponential backoff,
+        # anything else (e.g. 4xx, read timeouts while Plex is still
+        # working) fails straight away. Returns (resp, attempts, error).
+        headers = {'cache-control': "no-cache"}
+        import requests                              # for connection errors
+
+        querystring = urllib.parse.urlencode(OrderedDict(
+            list(params) + [("X-Plex-Token", self.plex_token)]))
+
+        attempt = 0
+        while True:
+            attempt += 1
+            retry = False
+            try:
+                resp = self.session.request(method, url, data="", headers=headers,
+                                            params=querystring, timeout=timeout)
+                self.record(resp)
+                if resp.ok:
+                    return resp, attempt, None
+                error = 'Return code: %d Reason: %s' % (resp.status_code, resp.reason)
+                retry = resp.status_code >= 500
+            except requests.ConnectionError as e:
+                error = self.hideToken(e)
+                retry = True
+            except Exception as e:
+                error = self.hideToken(e)
+
+            if not retry or attempt > retries:
+                return None, attempt, error
+
+            time.sleep(2 ** (attempt - 1))
+
+    def uploadPlaylist(self, section_id, plex_path, timeout=300, retries=3):
+        # Asks Plex to import the playlist at plex_path
+        start = time.time()
+        resp, attempts, error = self.send(
+            'POST', self.server_url + '/playlists/upload?',
+            [("sectionID", section_id), ("path", plex_path)], timeout, retries)
+        return resp is not None, attempts, time.time() - start, error
+
+    def uploadPlaylists(self, section_id, uploads, workers=2, timeout=300, retries=3):
+        # Upload playlists concurrently, where uploads is a list of
+        # (name, plex_path) pairs. Returns (name, ok, attempts, seconds, error)
+        # for each playlist, in the same order as uploads.
+        print("Sending %d updated playlists to Plex using %d workers..." %
+              (len(uploads), workers))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(
+                lambda upload: (upload[0],) + self.uploadPlaylist(
+                    section_id, upload[1], timeout, retries),
+                uploads))
+
+        for upload in results:
+            printUpload(upload)
+
+        return results
+
+    def machineIdentifier(self):
+        if self.machine_identifier is None:
+            root = self.get(self.server_url + "/?X-Plex-Token=" + self.plex_token)
+            self.machine_identifier = root.get('machineIdentifier')
+        return self.machine_identifier
+
+    def libraryUri(self, rating_keys):
+        return 'server://%s/com.plexapp.plugins.library/library/metadata/%s' % (
+            self.machineIdentifier(), ','.join(rating_keys))
+
+    def pushPlaylist(self, name, playlist, add, batch_size=200, timeout=300, retries=3):
+        # Changes a playlist through the playlist item endpoints instead of
+        # having Plex re-import it. playlist is the Plex listing entry, or
+        # None to create a new playlist called name. add holds the ratingKeys
+        # of tracks to add, sent batch_size at a time. Returns (ok, requests,
+        # seconds, error).
+        start = time.time()
+        sent = 0
+        batches = [add[i:i + batch_size] for i in range(0, len(add), batch_size)]
+
+        if playlist is None:
+            if not batches:
+                return False, sent, time.time() - start, 'None of its tracks are in the Plex library'
+            resp, attempts, error = self.send(
+                'POST', self.server_url + '/playlists',
+                [("type", "audio"), ("title", name), ("smart", "0"),
+                 ("uri", self.libraryUri(batches.pop(0)))], timeout, retries)
+            sent += attempts
+            if error:
+                return False, sent, time.time() - start, error
+            rating_key = ElementTree.fromstring(resp.text).find('Playlist').get('ratingKey')
+        else:
+            rating_key = playlist['ratingKey']
+
+        for batch in batches:
+            _, attempts, error = self.send(
+                'PUT', self.server_url + '/playlists/%s/items' % rating_key,
+                [("uri", self.libraryUri(batch))], timeout, retries)
+            sent += attempts
+            if error:
+                return False, sent, time.time() - start, error
+
+        return True, sent, time.time() - start, None
+
+    def pushPlaylists(self, pushes, workers=2, batch_size=200, timeout=300, retries=3):
+        # Push changes to playlists concurrently, where pushes is a list of
+        # (name, playlist, add) as taken by pushPlaylist(). Returns
+        # (name, ok, requests, seconds, error) for each playlist, in the same
+        # order as pushes.
+        print("Sending changes to %d playlists to Plex using %d workers..." %
+              (len(pushes), workers))
+        if any(push[2] for push in pushes):
+            self.machineIdentifier()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(
+                lambda push: (push[0],) + self.pushPlaylist(
+                    push[0][:-len('.m3u')], push[1], push[2],
+                    batch_size, timeout, retries),
+                pushes))
+
+        for push in results:
+            printPush(push)
+
+        return results
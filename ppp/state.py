@@ -0,0 +1,84 @@
+"""State of each playlist as it was left by the last sync."""
+
+import hashlib                               # for detecting changed playlists
+import io                                    # character encoding
+import json                                  # for saving of state
+import os                                    # for folder and file management
+
+from .util import fileHash, writeJson
+
+
+def localSignature(path, previous=None):
+    # The content hash is only recalculated if the mtime or size has changed
+    # since the previous signature was taken
+    stat = os.stat(path)
+    signature = {'path': path, 'mtime': stat.st_mtime, 'size': stat.st_size}
+    if previous and all(previous.get(k) == signature[k] for k in signature):
+        signature['hash'] = previous['hash']
+    else:
+        signature['hash'] = fileHash(path)
+    return signature
+
+
+def configHash(v):
+    return hashlib.sha1(json.dumps(v, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def loadState(path, config, full=False):
+    # State from a run with different variables can't be trusted, so it is
+    # discarded and every playlist is synced again
+    empty = {'config': config, 'playlists': {}}
+    if full or not os.path.isfile(path):
+        return empty
+    try:
+        with io.open(path, 'r', encoding='utf8') as f:
+            state = json.load(f)
+    except Exception as e:
+        print('WARNING: Unable to load %s, syncing all playlists (%s)' % (path, e))
+        return empty
+    if state.get('config') != config:
+        print('INFO: Variables have changed since the last run, syncing all playlists')
+        return empty
+    return state
+
+
+def saveState(path, state):
+    try:
+        writeJson(path, state, indent=2)
+    except Exception as e:
+        print('WARNING: Unable to save %s (%s)' % (path, e))
+
+
+def plexPlaylistsByName(listing):
+    # Map each playlist filename to its Plex listing entry, or None when more
+    # than one Plex playlist would be saved under the same filename
+    playlists = {}
+    for playlist in listing:
+        name = playlist['title'] + '.m3u'
+        playlists[name] = None if name in playlists else playlist
+    return playlists
+
+
+def unchangedPlaylists(state, plex_playlists, local_paths):
+    # Returns the state entries of playlists which haven't changed in Plex or
+    # locally since they were last synced
+    unchanged = {}
+    for name, previous in state['playlists'].items():
+        plex = plex_playlists.get(name)
+        paths = local_paths.get(name, [])
+        if not plex or len(paths) != 1:
+            continue
+        if (plex['key'], plex['updatedAt'], plex['leafCount']) != \
+                (previous['key'], previous['updatedAt'], previous['leafCount']):
+            continue
+        signature = localSignature(paths[0], previous['local'])
+        if signature['hash'] == previous['local']['hash']:
+            unchanged[name] = dict(previous, local=signature)
+    return unchanged
+
+
+def playlistState(plex, local_path):
+    return {'key': plex['key'],
+            'updatedAt': plex['updatedAt'],
+            'leafCount': plex['leafCount'],
+            'local': localSignature(local_path)}
@@ -0,0 +1,567 @@
+"""The sync pipeline between local and Plex playlists."""
+
+import os                                    # for folder and file management
+import shutil                                # for deleting files
+
+from .backup import backupLocal, listBackups, restoreBackup
+from .cache import PlaylistCache
+from .index import TrackIndex
+from .local import LocalPlaylistStore
+from .m3u import EXTENSIONS, Playlist, Track, playlistName, writePlaylist
+from .merge import addedTracks, mergePlaylists
+from .metrics import Metrics, savePrometheus, saveSummary
+from .paths import PathMapper, convertPath
+from .plex import PlexClient
+from .state import (configHash, loadState, plexPlaylistsByName, playlistState,
+                    saveState, unchangedPlaylists)
+from .util import PPPError, br, runTime, targetPath
+
+
+def dumpPlaylists(folder, playlists):
+    # Debug output of an intermediate stage, kept by -nocleanup
+    os.makedirs(folder, exist_ok=True)
+    for filename, tracks in playlists.items():
+        writePlaylist(os.path.join(folder, filename), tracks)
+
+
+class SyncResult:
+    # What a single SyncEngine.run() did. Playlists are identified by
+    # filename, uploaded holds (name, ok, attempts, seconds, error) for each
+    # playlist sent to Plex. copied and up_to_date hold the local playlist
+    # paths written and those which already matched the merged playlist.
+    # metrics holds the timings and counts of the run.
+    # diff holds the tracks a dry run would have added to each playlist.
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.skipped = []
+        self.new_plex = []
+        self.new_local = []
+        self.merged = []
+        self.download_errors = []
+        self.uploaded = []
+        self.copied = []
+        self.up_to_date = []
+        self.diff = {}
+        self.metrics = Metrics()
+
+    @property
+    def failed(self):
+        return [name for name, ok, _, _, _ in self.uploaded if not ok]
+
+    @property
+    def ok(self):
+        return not self.download_errors and not self.failed
+
+
+class SyncEngine:
+    # Syncs the playlists described by v, the variables from variables.json.
+    # One engine can run any number of syncs, reusing its Plex connections.
+    # name and store are set when the engine is one target of a MultiSync,
+    # store is then the local playlists shared by every target.
+
+    def __init__(self, v, workers=4, connections=4, page_size=5000, local_workers=8,
+                 upload_workers=2, timeout=300, retries=3, backups=True,
+                 backup_mode='copy', retention=10, full=False, nocleanup=False,
+                 index=True, push_mode='upload', batch_size=200, pipeline=False, dry_run=False,
+                 cache_size=500000, state_path='state.json',
+                 backup_dir='local_backups', index_path='track_index.json',
+                 cache_path='playlist_cache.json', metrics_path='metrics.json',
+                 prometheus_path=None, name=None, store=None):
+        self.v = v
+        self.name = name
+        self.workers = workers
+        self.page_size = page_size
+        self.upload_workers = upload_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backups = backups
+        self.backup_mode = backup_mode
+        self.retention = retention
+        self.full = full
+        self.nocleanup = nocleanup
+        self.push_mode = push_mode
+        self.batch_size = batch_size
+        self.pipeline = pipeline
+        self.dry_run = dry_run
+        self.state_path = state_path
+        self.backup_dir = backup_dir
+        self.metrics_path = metrics_path
+        self.prometheus_path = prometheus_path
+
+        self.plex = PlexClient(v['server_url'], v['plex_token'],
+                               v['check_ssl'] != "False", connections)
+        self.store = store or LocalPlaylistStore(v['local_playlists'], local_workers)
+        self.local_mapper = PathMapper(v['local_prepend'], v['local_convert'])
+        self.plex_mapper = PathMapper(v['plex_prepend'], v['plex_convert'])
+        if len(self.local_mapper.prepends) != len(self.plex_mapper.prepends):
+            raise PPPError('local_prepend and plex_prepend must have the same number of paths')
+
+        # Index of the music section, for matching tracks moved since they
+        # were added to a local playlist. The index and the playlist cache can
+        # be large, so are only loaded once a sync needs them.
+        self.index = None
+        if index:
+            self.index = TrackIndex(index_path, v['section_id'], self.plex_mapper)
+        elif push_mode == 'items':
+            raise PPPError('Pushing playlist items needs the track index, it can\'t be used with -noindex')
+
+        # Plex playlists as last downloaded, so unchanged ones aren't
+        # downloaded again. A cache_size of 0 turns it off.
+        self.cache = None
+        if cache_size:
+            self.cache = PlaylistCache(cache_path, v['server_url'], cache_size, full)
+        self.plex.cache = self.cache
+
+        # Playlists written for Plex to import this sync, in Plex path style
+        self.sent = {}
+
+        self.tmp_name = targetPath('.tmp', name)
+        self.tmp = os.path.join(v['working_directory'], self.tmp_name)
+
+    def setupFolders(self):
+        # Remove existing temporary directory
+        if os.path.isdir(self.tmp):
+            try:
+                shutil.rmtree(self.tmp)
+            except Exception as e:
+                raise PPPError("I couldn't remove existing .tmp folder. Try deleting manually? %s" % e)
+
+        # Folder operations
+        try:
+            print('Attempting to make .tmp folders')
+            os.makedirs(os.path.join(self.tmp, 'plex'))
+            if self.nocleanup:
+                os.makedirs(os.path.join(self.tmp, 'debug'))
+            print('Successfully created .tmp folders')
+
+        except Exception as e:
+            raise PPPError("OH NO: Couldn't make tmp directories... check your permissions or make sure you don't have them open elsewhere. %s" % e)
+
+        self.setupBackupFolder()
+
+        br()
+
+    def setupBackupFolder(self):
+        # Create backups folder if required
+        if not os.path.isdir(self.backup_dir) and self.backups:
+            print('No local backups detected... making local_backups folder.')
+            os.makedirs(self.backup_dir, exist_ok=True)
+
+    def cleanup(self):
+        if not self.nocleanup:
+            try:
+                shutil.rmtree(self.tmp)
+            except Exception as e:
+                print("I had trouble cleaning .tmp directory. Check it's not open somewhere else \n ERROR: %s" % e)
+
+    def backup(self, runtime, prune=True):
+        if self.backups:
+            backupLocal(self.v['local_playlists'], self.backup_dir, runtime,
+                        self.backup_mode, self.retention, prune)
+        else:
+            print('Not backing up local playlists. If this was NOT intentional, exit the program immediately\n')
+            br()
+
+    def backupOnce(self, runtime):
+        # Targets sharing the local playlists back them up once per run,
+        # before the first of them writes to them
+        with self.store.lock:
+            if self.store.backed_up != runtime:
+                self.backup(runtime)
+                self.store.backed_up = runtime
+
+    def listBackups(self):
+        return listBackups(self.backup_dir)
+
+    def restore(self, name):
+        # Back up the current playlists first, so a restore can be undone. Old
+        # backups aren't pruned, as that could delete the one being restored.
+        self.setupBackupFolder()
+        self.backup(runTime(), prune=False)
+        restoreBackup(self.v['local_playlists'], self.backup_dir, name)
+
+    def resolve(self, names, listing, local_paths):
+        # Find the playlist filenames for names given by the user. A name can
+        # be the playlist title with or without .m3u or .m3u8, or its Plex key
+        # or ratingKey.
+        filenames = set()
+        for name in names:
+            matches = {playlist['title'] + '.m3u' for playlist in listing
+                       if name in (playlist['key'], playlist['ratingKey'])}
+            if not matches:
+                filename = playlistName(name) if name.endswith(EXTENSIONS) else name + '.m3u'
+                if filename in local_paths or \
+                        any(playlist['title'] + '.m3u' == filename for playlist in listing):
+                    matches = {filename}
+            if not matches:
+                raise PPPError("Couldn't find playlist '%s' locally or in Plex" % name)
+            filenames |= matches
+        return filenames
+
+    def dumpDebug(self, plex_lists, local_lists, merged_lists):
+        debug = os.path.join(self.tmp, 'debug')
+        dumpPlaylists(os.path.join(debug, 'plex'), plex_lists)
+        dumpPlaylists(os.path.join(debug, 'local'), local_lists)
+        dumpPlaylists(os.path.join(debug, 'merged'), merged_lists)
+
+    def writePlexPlaylist(self, filename, tracks):
+        # Re-add prepends and write a playlist for Plex to import to
+        # tmp/plex/. Returns its path as seen by Plex.
+        tracks = [track.withPath(self.plex_mapper.fromPPP(track.path)) for track in tracks]
+        writePlaylist(os.path.join(self.tmp, 'plex', filename), tracks)
+
+        # With the index every track has the path Plex has for it, so once
+        # imported the playlist can be cached as it was sent
+        if self.cache and self.index:
+            self.sent[filename] = [track.path for track in tracks]
+        return convertPath(os.path.join(self.v['working_directory_plex'], self.tmp_name, 'plex', filename),
+                           self.v['plex_convert'], True)
+
+    def upload(self, merged_lists):
+        # POST new playlists to Plex
+        uploads = [(filename, self.writePlexPlaylist(filename, tracks))
+                   for filename, tracks in merged_lists.items()]
+
+        return self.plex.uploadPlaylists(
+            self.v['section_id'], uploads, self.upload_workers, self.timeout, self.retries)
+
+    def itemChanges(self, filename, tracks, plex_tracks, playlist):
+        # Work out the (name, playlist, add) push which makes the Plex
+        # playlist hold tracks, as taken by PlexClient.pushPlaylist().
+        # plex_tracks is None for a playlist which isn't in Plex yet. Merging
+        # never drops a Plex track, so tracks only ever need adding.
+        if plex_tracks is not None and playlist is None:
+            raise PPPError('More than one Plex playlist is called ' + filename[:-len('.m3u')])
+
+        add = addedTracks(plex_tracks or [], tracks)
+
+        keys = [self.index.ratingKey(track.path) for track in add]
+        missing = keys.count(None)
+        if missing:
+            print('WARNING: %d tracks in %s aren\'t in the Plex library and weren\'t added' %
+                  (missing, filename))
+
+        return filename, playlist, [key for key in keys if key]
+
+    def pushItems(self, merged_lists, plex_lists, plex_playlists):
+        # Send only the tracks added to each playlist, by
+        # ratingKey, so nothing needs to be written where Plex can read it
+        pushes = []
+        failed = []
+        for filename, tracks in merged_lists.items():
+            try:
+                pushes.append(self.itemChanges(filename, tracks, plex_lists.get(filename),
+                                               plex_playlists.get(filename)))
+            except PPPError as e:
+                failed.append((filename, False, 0, 0.0, str(e)))
+
+        return failed + self.plex.pushPlaylists(pushes, self.upload_workers, self.batch_size,
+                                                self.timeout, self.retries)
+
+    def mergePlaylist(self, result, filename, plex_tracks, local_tracks):
+        # Merge one playlist, either side is None if the playlist doesn't
+        # exist there, in which case the other side is used as it is
+        if local_tracks is None:
+            print(('Found new Plex playlist: ' + filename))
+            merged = plex_tracks
+            result.new_plex.append(filename)
+        elif plex_tracks is None:
+            print(('Found new local playlist: ' + filename))
+            merged = local_tracks
+            result.new_local.append(filename)
+        else:
+            print(('Merging: ' + filename))
+            merged = mergePlaylists(local_tracks, plex_tracks)
+            result.merged.append(filename)
+        result.metrics.count('tracks_merged', len(merged))
+        return merged
+
+    def copyBack(self, result, filename, tracks, local_playlists, local_paths):
+        # Re-add prepends and write an updated playlist back to the local
+        # playlists. New playlists go in the root directory.
+        playlist = local_playlists.get(filename, Playlist())
+        written, unchanged = self.store.write(
+            filename, [track.withPath(self.local_mapper.fromPPP(track.path)) for track in tracks],
+            local_paths, playlist.header, playlist.footer)
+        result.copied += written
+        result.up_to_date += unchanged
+
+    def diff(self, result, merged_lists, plex_lists, local_lists):
+        # Record and print the tracks the sync would add to each side. New
+        # playlists are listed even if they are empty.
+        for filename, tracks in merged_lists.items():
+            to_local = addedTracks(local_lists.get(filename, []), tracks)
+            to_plex = addedTracks(plex_lists.get(filename, []), tracks)
+            if not to_local and not to_plex and filename in local_lists and filename in plex_lists:
+                continue
+
+            result.diff[filename] = {
+                'local': [self.local_mapper.fromPPP(track.path) for track in to_local],
+                'plex': [self.plex_mapper.fromPPP(track.path) for track in to_plex]}
+
+            if filename not in local_lists:
+                print('New local playlist: %s (%d tracks)' % (filename, len(to_local)))
+            elif filename not in plex_lists:
+                print('New Plex playlist: %s (%d tracks)' % (filename, len(to_plex)))
+            else:
+                print('%s: %d tracks to add locally, %d tracks to add to Plex' %
+                      (filename, len(to_local), len(to_plex)))
+                for track in result.diff[filename]['local']:
+                    print('  + local: ' + track)
+                for track in result.diff[filename]['plex']:
+                    print('  + Plex:  ' + track)
+
+        if not result.diff:
+            print('No changes to make')
+        br()
+
+    def plexTracks(self, result, title, playlist):
+        # Normalise a downloaded Plex playlist to PPP path style
+        print("Found playlist: " + title)
+        print("Found " + str(len(playlist)) + " songs.")
+        result.metrics.count('tracks_plex', len(playlist))
+        br()
+        return [Track(self.plex_mapper.toPPP(track)) for track in playlist]
+
+    def loadLocal(self, result, local_paths, unchanged):
+        # Load the local playlists which may have changed, normalised to PPP
+        # path style and keeping their metadata. Returns the playlists as
+        # read, and their tracks in PPP path style.
+        stage = result.metrics.stage
+        local_lists = {}
+        with stage('local_load'):
+            local_playlists = self.store.load({name: paths for name, paths in local_paths.items()
+                                               if name not in unchanged})
+            for filename, playlist in local_playlists.items():
+                local_lists[filename] = [track.withPath(self.local_mapper.toPPP(track.path))
+                                         for track in playlist.tracks]
+                result.metrics.count('tracks_local', len(playlist.tracks))
+
+        br()
+
+        # Replace the paths of local tracks which have been moved or renamed
+        # with the path Plex has for them, so they merge with the Plex copy
+        # instead of being added twice
+        if self.index and (local_lists or self.push_mode == 'items'):
+            with stage('index'):
+                self.index.refresh(self.plex, self.full)
+            total = 0
+            for filename, playlist in local_playlists.items():
+                tracks = local_lists[filename]
+                resolved = [track.withPath(self.index.resolve(track.path, original.path))
+                            for track, original in zip(tracks, playlist.tracks)]
+                moved = sum(a.path != b.path for a, b in zip(tracks, resolved))
+                if moved:
+                    print('Matched %d moved or renamed tracks in %s' % (moved, filename))
+                local_lists[filename] = resolved
+                total += moved
+            result.metrics.count('tracks_moved', total)
+            if total:
+                br()
+
+        return local_playlists, local_lists
+
+    def download(self, result, changed):
+        # Download all Plex playlists, normalised to PPP path style. Returns
+        # None if any failed.
+        with result.metrics.stage('download'):
+            if self.cache:
+                self.cache.load()
+            playlists = self.plex.playlists(changed, self.workers, self.page_size)
+            self.saveCache()
+
+        for key, _, _, error in playlists:
+            if error:
+                print('ERROR: Failed to download Plex playlist %s: %s' % (key, error))
+                result.download_errors.append((key, error))
+
+        if result.download_errors:
+            return None
+
+        plex_lists = {}
+        for key, title, playlist, _ in playlists:
+            plex_lists[title + '.m3u'] = self.plexTracks(result, title, playlist)
+        return plex_lists
+
+    def syncStages(self, result, changed, plex_lists, local_paths, unchanged):
+        # Each stage runs for every playlist before the next one starts.
+        # Returns False if the sync stopped before anything was sent.
+        stage = result.metrics.stage
+
+        local_playlists, local_lists = self.loadLocal(result, local_paths, unchanged)
+
+        # Merge playlists, any which only exist on one side are used as they are
+        merged_lists = {}
+        with stage('merge'):
+            for filename in sorted(set(plex_lists) | set(local_lists)):
+                merged_lists[filename] = self.mergePlaylist(
+                    result, filename, plex_lists.get(filename), local_lists.get(filename))
+
+        br()
+
+        if self.dry_run:
+            self.diff(result, merged_lists, plex_lists, local_lists)
+            return False
+
+        if self.nocleanup:
+            self.dumpDebug(plex_lists, local_lists, merged_lists)
+
+        with stage('upload'):
+            if self.push_mode == 'items':
+                result.uploaded = self.pushItems(merged_lists, plex_lists, plexPlaylistsByName(changed))
+            else:
+                result.uploaded = self.upload(merged_lists)
+
+        br()
+
+        # Write updated playlists back to the local playlists
+        with stage('copy_back'):
+            for filename, tracks in merged_lists.items():
+                self.copyBack(result, filename, tracks, local_playlists, local_paths)
+
+        br()
+        return True
+
+    def run(self, playlists=None):
+        # Sync every playlist, or only the playlists named in playlists. The
+        # metrics of the run are saved however it ends.
+        result = SyncResult(runTime())
+        self.plex.metrics = result.metrics
+        completed = False
+        try:
+            self.sync(result, playlists)
+            completed = True
+        finally:
+            self.plex.metrics = None
+            result.metrics.finish()
+            self.saveMetrics(result, completed)
+        return result
+
+    def saveMetrics(self, result, completed):
+        # Dry runs aren't recorded, so monitoring only sees real syncs
+        if self.dry_run:
+            return
+        summary = result.metrics.summary(result, completed)
+        if self.name:
+            summary['target'] = self.name
+        if self.metrics_path:
+            saveSummary(self.metrics_path, summary)
+        if self.prometheus_path:
+            savePrometheus(self.prometheus_path, summary)
+
+    def sync(self, result, playlists=None, local_paths=None):
+        stage = result.metrics.stage
+
+        # Get all Plex music playlists
+        with stage('listing'):
+            listing = self.plex.playlistListing()
+        if local_paths is None:
+            with stage('local_scan'):
+                local_paths = self.store.paths()
+
+        # State of playlists outside of this sync is kept as it is
+        state = loadState(self.state_path, configHash(self.v), self.full)
+        playlists_state = {}
+
+        if playlists:
+            targets = self.resolve(playlists, listing, local_paths)
+            print('Syncing only: ' + ', '.join(sorted(targets)))
+            br()
+            listing = [playlist for playlist in listing
+                       if playlist['title'] + '.m3u' in targets]
+            local_paths = {name: paths for name, paths in local_paths.items()
+                           if name in targets}
+            playlists_state = {name: previous for name, previous in state['playlists'].items()
+                               if name not in targets}
+
+        # Skip playlists which haven't changed on either side since the last run
+        with stage('compare_state'):
+            plex_playlists = plexPlaylistsByName(listing)
+            unchanged = unchangedPlaylists(state, plex_playlists, local_paths)
+        playlists_state.update(unchanged)
+        result.skipped = sorted(unchanged)
+
+        if unchanged:
+            print('Skipping %d playlists unchanged since the last run' % len(unchanged))
+            br()
+
+        if len(unchanged) == len(set(plex_playlists) | set(local_paths)):
+            if not self.dry_run:
+                state['playlists'] = playlists_state
+                saveState(self.state_path, state)
+            print('All playlists are up to date!\n')
+            return
+
+        changed = [playlist for playlist in listing
+                   if playlist['title'] + '.m3u' not in unchanged]
+
+        # Create tmp and backup folders if required, and back up local playlists
+        if self.dry_run:
+            print('Dry run, nothing will be backed up, sent to Plex or copied to local playlists')
+            br()
+        else:
+            with stage('setup_folders'):
+                self.setupFolders()
+            with stage('backup'):
+                self.backupOnce(result.runtime)
+
+        # Everything from reading the local playlists to saving the state
+        # happens under the store's lock, so targets sharing the local
+        # playlists each merge into what the one before them wrote back
+        if self.pipeline and not self.dry_run:
+            from .pipeline import runPipeline  # imports asyncio, only needed here
+            with self.store.lock:
+                local_playlists, local_lists = self.loadLocal(result, local_paths, unchanged)
+                with stage('pipeline'):
+                    if self.cache:
+                        self.cache.load()
+                    try:
+                        runPipeline(self, result, changed, local_lists, local_playlists, local_paths)
+                    finally:
+                        self.saveCache()
+                br()
+                self.saveSyncState(result, state, playlists_state)
+        else:
+            plex_lists = self.download(result, changed)
+            if plex_lists is None:
+                return
+            with self.store.lock:
+                if not self.syncStages(result, changed, plex_lists, local_paths, unchanged):
+                    return
+                self.saveSyncState(result, state, playlists_state)
+
+        self.cleanup()
+
+    def saveCache(self):
+        if self.cache:
+            self.cache.save()
+
+    def saveSyncState(self, result, state, playlists_state):
+        # Record the state of every synced playlist, failed uploads are left
+        # out so they are retried on the next run
+        with result.metrics.stage('save_state'):
+            synced = [name for name, ok, _, _, _ in result.uploaded if ok]
+            if synced:
+                plex_playlists = plexPlaylistsByName(self.plex.playlistListing())
+                local_paths = self.store.paths()
+
+            for name in synced:
+                plex = plex_playlists.get(name)
+                paths = local_paths.get(name, [])
+                if plex and len(paths) == 1:
+                    playlists_state[name] = playlistState(plex, paths[0])
+                self.cacheSent(name, plex)
+
+            state['playlists'] = playlists_state
+            saveState(self.state_path, state)
+            self.saveCache()
+        self.sent = {}
+
+    def cacheSent(self, filename, playlist):
+        # Cache a playlist as it was sent to Plex, so the next sync doesn't
+        # download it again. Plex leaves out any tracks it couldn't find,
+        # which shows in its track count, and then it isn't cached.
+        tracks = self.sent.pop(filename, None)
+        if tracks is not None and playlist and playlist['leafCount'] == str(len(tracks)):
+            self.cache.put(playlist, playlist['title'], tracks, {})
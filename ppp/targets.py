@@ -0,0 +1,213 @@
+"""Syncing the same local playlists to more than one Plex server or library."""
+
+import os                                    # for folder and file management
+import re                                    # for checking target names
+from concurrent.futures import ThreadPoolExecutor  # for syncing targets at once
+
+from .local import LocalPlaylistStore
+from .m3u import playlistName
+from .metrics import Metrics
+from .sync import SyncEngine, SyncResult
+from .util import PPPError, br, runTime, targetPath
+
+# Variables every target needs, from the target itself or the top level
+REQUIRED = ('server_url', 'plex_token', 'check_ssl', 'section_id', 'working_directory',
+            'working_directory_plex', 'local_prepend', 'plex_prepend', 'local_convert',
+            'plex_convert')
+
+# Target names are used in file names
+NAME = re.compile(r'^[\w.-]+$')
+
+
+def targetVariables(v):
+    # The variables for each sync target in v, as a list of (name, variables).
+    # A variables.json without 'targets' is a single target without a name.
+    # Otherwise each target's variables are the ones at the top level, with
+    # the target's own on top. local_playlists is shared by every target, so
+    # must be at the top level.
+    if 'targets' not in v:
+        return [(None, v)]
+
+    if 'local_playlists' not in v:
+        raise PPPError('local_playlists must be set outside of targets, as every target shares it')
+    if not v['targets']:
+        raise PPPError('targets is empty, add a target or remove it to sync to a single server')
+
+    defaults = {key: value for key, value in v.items() if key != 'targets'}
+    targets = []
+    for i, target in enumerate(v['targets']):
+        name = target.get('name')
+        if not name or not NAME.match(name):
+            raise PPPError('Target %d needs a name, made of letters, numbers, ".", "-" and "_"' %
+                           (i + 1))
+        if name in dict(targets):
+            raise PPPError('More than one target is called ' + name)
+        if 'local_playlists' in target:
+            raise PPPError('Target %s sets local_playlists, which must be set outside of targets' %
+                           name)
+
+        variables = dict(defaults)
+        variables.update((key, value) for key, value in target.items() if key != 'name')
+        if 'working_directory_plex' not in variables and 'working_directory' in variables:
+            variables['working_directory_plex'] = variables['working_directory']
+
+        missing = [key for key in REQUIRED if key not in variables]
+        if missing:
+            raise PPPError('Target %s is missing %s' % (name, ', '.join(missing)))
+        targets.append((name, variables))
+    return targets
+
+
+class MultiSyncResult:
+    # What a single MultiSync.run() did, with the SyncResult of each target
+    # by name. errors holds the message for each target which couldn't sync.
+    # metrics holds the timings of the run as a whole.
+
+    def __init__(self, runtime, names):
+        self.runtime = runtime
+        self.targets = {name: SyncResult(runtime) for name in names}
+        self.errors = {}
+        self.metrics = Metrics()
+
+    @property
+    def download_errors(self):
+        return [('%s: %s' % (name, key), error) for name, result in self.targets.items()
+                for key, error in result.download_errors]
+
+    @property
+    def uploaded(self):
+        return [('%s: %s' % (name, upload[0]),) + upload[1:] for name, result in self.targets.items()
+                for upload in result.uploaded]
+
+    @property
+    def failed(self):
+        return [name for name, ok, _, _, _ in self.uploaded if not ok]
+
+    @property
+    def copied(self):
+        return [path for result in self.targets.values() for path in result.copied]
+
+    @property
+    def up_to_date(self):
+        return [path for result in self.targets.values() for path in result.up_to_date]
+
+    @property
+    def diff(self):
+        return {name: result.diff for name, result in self.targets.items()}
+
+    @property
+    def ok(self):
+        return not self.errors and all(result.ok for result in self.targets.values())
+
+
+class MultiSync:
+    # Syncs the local playlists to every target in v, see targetVariables().
+    # The targets sync at once, sharing a single LocalPlaylistStore so the
+    # local playlists are listed, read and backed up once per run. Each
+    # target has its own Plex connections, working folder, state, track
+    # index, playlist cache and metrics, in files named after it (e.g.
+    # state-home.json).
+    # Takes the same options as SyncEngine, which apply to every target.
+
+    def __init__(self, v, local_workers=8, state_path='state.json',
+                 index_path='track_index.json', cache_path='playlist_cache.json',
+                 metrics_path='metrics.json', prometheus_path=None, **options):
+        self.v = v
+        self.store = LocalPlaylistStore(v['local_playlists'], local_workers)
+        self.engines = {}
+        for name, variables in targetVariables(v):
+            self.engines[name] = SyncEngine(
+                variables, local_workers=local_workers,
+                state_path=targetPath(state_path, name),
+                index_path=targetPath(index_path, name),
+                cache_path=targetPath(cache_path, name),
+                metrics_path=metrics_path and targetPath(metrics_path, name),
+                prometheus_path=prometheus_path and targetPath(prometheus_path, name),
+                name=name, store=self.store, **options)
+
+        # Backups are shared, so any target can list and restore them
+        self.first = next(iter(self.engines.values()))
+        self.dry_run = self.first.dry_run
+
+    def listBackups(self):
+        return self.first.listBackups()
+
+    def restore(self, name):
+        self.first.restore(name)
+
+    def syncTarget(self, result, name, playlists, local_paths):
+        # Returns why the target couldn't sync, or None if it did. A target
+        # which fails doesn't stop the others.
+        engine = self.engines[name]
+        print('Syncing target: ' + name)
+        br()
+        engine.plex.metrics = result.metrics
+        try:
+            engine.sync(result, playlists, local_paths)
+            return None
+        except PPPError as e:
+            print('ERROR: %s: %s' % (name, e))
+            return str(e)
+        finally:
+            engine.plex.metrics = None
+
+    def resyncTarget(self, result, name, playlists, local_paths):
+        # A later sync of playlists already synced this run. Its playlists
+        # are added to result, but not the ones it skipped, as they were
+        # already counted.
+        again = SyncResult(result.runtime)
+        again.metrics = result.metrics
+        error = self.syncTarget(again, name, playlists, local_paths)
+        for attribute in ('new_plex', 'new_local', 'merged', 'download_errors', 'uploaded',
+                          'copied', 'up_to_date'):
+            getattr(result, attribute).extend(getattr(again, attribute))
+        return error
+
+    def syncTargets(self, result, sync, playlists, local_paths):
+        # Run sync for every target in playlists at once
+        names = list(playlists)
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            errors = list(pool.map(
+                lambda name: sync(result.targets[name], name, playlists[name], local_paths),
+                names))
+
+        for name, error in zip(names, errors):
+            if error:
+                result.errors.setdefault(name, error)
+
+    def run(self, playlists=None):
+        # Sync every playlist, or only the playlists named in playlists, to
+        # every target. The metrics of each target are saved however it ends.
+        result = MultiSyncResult(runTime(), self.engines)
+        stage = result.metrics.stage
+        try:
+            with stage('local_scan'):
+                local_paths = self.store.paths()
+            with stage('sync'):
+                self.syncTargets(result, self.syncTarget,
+                                 {name: playlists for name in self.engines}, local_paths)
+
+            # Targets take turns writing back to the local playlists, so a
+            # target which went before another is missing the tracks that one
+            # added. Playlists written back by another target are synced again.
+            if not self.dry_run:
+                written = {name: {playlistName(os.path.basename(path)) for path in target.copied}
+                           for name, target in result.targets.items()}
+                again = {}
+                for name in self.engines:
+                    names = set().union(*(written[other] for other in written if other != name))
+                    if names and name not in result.errors:
+                        again[name] = sorted(names)
+                if again:
+                    print('Syncing playlists changed by other targets to: ' + ', '.join(again))
+                    br()
+                    with stage('resync'):
+                        local_paths = self.store.paths()
+                        self.syncTargets(result, self.resyncTarget, again, local_paths)
+        finally:
+            for name, engine in self.engines.items():
+                target = result.targets[name]
+                target.metrics.finish()
+                engine.saveMetrics(target, name not in result.errors)
+            result.metrics.finish()
+        return result
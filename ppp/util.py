@@ -0,0 +1,55 @@
+"""Helpers shared across PPP."""
+
+import hashlib                               # for detecting changed files
+import io                                    # character encoding
+import json                                  # for saving json files
+import os                                    # for file names
+from datetime import datetime                # for timestamp
+
+
+class PPPError(Exception):
+    # Raised when a sync can't continue. The message is shown to the user.
+    pass
+
+
+def br():
+    print("\n------\n")
+
+
+def fileHash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def writeFile(path, text):
+    # Written in full then moved into place, so a reader (e.g. the
+    # Prometheus node exporter or the next run) never sees half a file
+    with io.open(path + '.tmp', 'w', encoding='utf8') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def writeJson(path, obj, indent=None):
+    # As writeFile(), but streams the json so large files (e.g. the track
+    # index) aren't built up in memory first
+    with io.open(path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(obj, f, indent=indent)
+    os.replace(path + '.tmp', path)
+
+
+def targetPath(path, name):
+    # The file a sync target keeps its own copy of path in, e.g. state.json
+    # becomes state-home.json for the target named home. A target without a
+    # name uses path itself.
+    if not name:
+        return path
+    root, ext = os.path.splitext(path)
+    return '%s-%s%s' % (root, name, ext)
+
+
+def runTime():
+    # Timestamp of a run, also used to name its backup
+    return str(datetime.now().replace(microsecond=0)).replace(' ', '-').replace(':', '-')
@@ -0,0 +1,164 @@
+"""Watch mode, syncing whenever playlists change instead of on a schedule."""
+
+import ctypes                                # for inotify
+import ctypes.util
+import os                                    # for folder and file management
+import select                                # for waiting on inotify
+import struct                                # for reading inotify events
+import time                                  # for polling intervals
+
+from .m3u import EXTENSIONS
+from .util import PPPError, br
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+
+class InotifyWatcher:
+    # Reports changes to playlists under a directory using Linux inotify.
+    # Every folder needs its own watch, including ones created later.
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, directory):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.folders = {}
+        for root, _, _ in os.walk(directory):
+            self.add(root)
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd >= 0:
+            self.folders[wd] = path
+
+    def wait(self, timeout):
+        # Returns the names of changed playlists, or an empty set if nothing
+        # changed within timeout seconds. Changes to other files (e.g. temp
+        # files) don't count, so keep reading until the time is up.
+        end = time.time() + timeout
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], max(0, end - time.time()))
+            if not ready:
+                return set()
+            changed = self.read()
+            if changed:
+                return changed
+
+    def read(self):
+        events = os.read(self.fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(events):
+            wd, mask, _, length = struct.unpack_from('iIII', events, offset)
+            name = os.fsdecode(events[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.add('(too many changes to list)')
+            elif mask & IN_ISDIR:
+                # Watch new folders, playlists already in them are picked up
+                # by the sync anyway
+                if mask & (IN_CREATE | IN_MOVED_TO) and wd in self.folders:
+                    path = os.path.join(self.folders[wd], name)
+                    for root, _, _ in os.walk(path):
+                        self.add(root)
+                    changed.add(name + os.sep)
+            elif name.endswith(EXTENSIONS):
+                changed.add(name)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    # Fallback for systems without inotify, comparing the mtime and size of
+    # every playlist every interval seconds
+
+    def __init__(self, directory, interval=2):
+        self.directory = directory
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith(EXTENSIONS):
+                    path = os.path.join(root, file)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def wait(self, timeout):
+        end = time.time() + timeout
+        while True:
+            snapshot = self.scan()
+            changed = {os.path.basename(path) for path in set(snapshot) | set(self.snapshot)
+                       if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changed or time.time() >= end:
+                return changed
+            time.sleep(min(self.interval, max(0, end - time.time())))
+
+    def close(self):
+        pass
+
+
+def localWatcher(directory):
+    try:
+        return InotifyWatcher(directory)
+    except (OSError, AttributeError, TypeError):
+        print('INFO: inotify is not available, checking for changes to local playlists every 2 seconds')
+        return PollingWatcher(directory)
+
+
+def watch(engine, poll_interval=60, debounce=2, report=None, playlists=None):
+    # Runs engine forever. A sync starts once local playlists have stopped
+    # changing for debounce seconds, or every poll_interval seconds to pick up
+    # changes made in Plex. The sync itself skips any playlists which haven't
+    # changed, and as it compares every local playlist it also catches
+    # anything the watcher missed (e.g. changes made on a network share).
+    # playlists limits each sync to those playlists, as for engine.run().
+    watcher = localWatcher(engine.v['local_playlists'])
+    print('Watching %s for changes, and checking Plex every %d seconds' %
+          (engine.v['local_playlists'], poll_interval))
+    br()
+
+    try:
+        while True:
+            try:
+                result = engine.run(playlists)
+                if report:
+                    report(result)
+            except PPPError as e:
+                print('ERROR: %s' % e)
+
+            # Ignore changes made by the sync itself
+            while watcher.wait(0):
+                pass
+
+            changed = watcher.wait(poll_interval)
+            if changed:
+                # Wait for a burst of edits to finish before syncing
+                while True:
+                    more = watcher.wait(debounce)
+                    if not more:
+                        break
+                    changed |= more
+                print('Local playlists changed: ' + ', '.join(sorted(changed)))
+            else:
+                print('Checking Plex for changes...')
+            br()
+    finally:
+        watcher.close()
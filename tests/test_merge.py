@@ -0,0 +1,55 @@
+"""Tests that mergePlaylists matches the original merge."""
+
+import random                                # for generating playlists
+
+from ppp.m3u import Track
+from ppp.merge import mergePlaylists
+
+
+def originalMerge(local_tracks, plex_tracks):
+    # The merge as PPP first did it, kept as the reference
+    merged = [line for line in local_tracks if not line.startswith('#')]
+    remaining = list(local_tracks)
+    for line in plex_tracks:
+        if line in remaining:
+            remaining.remove(line)
+        else:
+            merged.append(line)
+    return merged
+
+
+def randomPlaylist(rng, pool):
+    # Small pools make for plenty of duplicates and shared tracks
+    return [rng.choice(pool) for _ in range(rng.randint(0, 30))]
+
+
+def test_fixed_cases():
+    cases = [
+        ([], []),
+        (['a'], []),
+        ([], ['a']),
+        (['a', 'b'], ['b', 'c']),
+        (['#EXTM3U', 'a', '#EXTINF:1,A', 'b'], ['a', 'c', 'b', 'd']),
+        (['a', 'a'], ['a', 'a', 'a']),
+        (['a', 'b', 'a'], ['a', 'c', 'a', 'b', 'b']),
+        (['#x', '#x'], ['#x', '#x', '#x', 'a']),
+    ]
+    for local, plex in cases:
+        assert mergePlaylists(local, plex) == originalMerge(local, plex)
+
+
+def test_randomised():
+    rng = random.Random(4)
+    pool = ['/music/%d.mp3' % i for i in range(8)] + ['#EXTM3U', '#EXTINF:1,A']
+    for _ in range(5000):
+        local = randomPlaylist(rng, pool)
+        plex = randomPlaylist(rng, pool)
+        assert mergePlaylists(local, plex) == originalMerge(local, plex)
+
+
+def test_tracks_match_by_path():
+    local = [Track('/music/a.mp3', '1,A'), Track('/music/b.mp3')]
+    plex = [Track('/music/a.mp3'), Track('/music/c.mp3')]
+    merged = mergePlaylists(local, plex)
+    assert [track.path for track in merged] == ['/music/a.mp3', '/music/b.mp3', '/music/c.mp3']
+    assert merged[0].info == '1,A'